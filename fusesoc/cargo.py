@@ -29,44 +29,356 @@
 # OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
 # USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import os
 import sys
+import json
+import shutil
 import subprocess
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from fusesoc.capi2.generator import Generator
 
+from jobserver import get_jobserver
+from outputs import output_lock, write_text_atomic
+from cargo_timings import (
+    CargoTimings, supports_json_timings, cargo_options, print_report)
+
 
 class CargoGen(Generator):
     def run(self):
         project_dir = self.config.get("project_dir", ".")
         args = self.config.get("args")
+        images = self.config.get("images")
 
-        if not args:
-            print("ERROR: 'args' is a required parameter")
+        if not args and not images:
+            print("ERROR: 'args' or 'images' is a required parameter")
             sys.exit(1)
 
         files_root = Path(self.files_root)
         cargo_cwd = files_root / project_dir
+        profile = self.config.get("timings", False)
+
+        if images:
+            self.run_images(files_root, project_dir, images, args or [],
+                            profile)
+            return
 
         if not (cargo_cwd / "Cargo.toml").exists():
             print(f"ERROR: Cargo.toml not found in {cargo_cwd}")
             sys.exit(1)
 
+        timings = None
+        if profile:
+            timings = CargoTimings()
+
+        if timings is not None:
+            # cargo's own options go before any `--` for a subcommand's tool
+            options = cargo_options(supports_json_timings(cargo_cwd))
+            if "--" in args:
+                split = args.index("--")
+                args = args[:split] + options + args[split:]
+            else:
+                args = args + options
         command = ["cargo"] + args
 
         print(f"Running cargo in: {cargo_cwd}")
         print(f"Command: {' '.join(command)}")
 
-        try:
-            subprocess.check_call(command, cwd=cargo_cwd)
-        except subprocess.CalledProcessError as e:
-            print(f"ERROR: Cargo failed with return code {e.returncode}")
+        # cargo takes its job tokens from the build's jobserver, if any
+        jobserver = get_jobserver()
+
+        # cargo locks its own build directory, but post-build steps (objcopy,
+        # elfsize) read artifacts that a concurrent build could be replacing
+        with output_lock(cargo_cwd / "target"):
+            if timings is not None:
+                self.run_cargo_json(
+                    command, cargo_cwd, jobserver, timings.add_message,
+                    timings.start_clock)
+                self.write_timings(
+                    files_root, project_dir, {cargo_cwd: timings})
+                return
+
+            try:
+                with jobserver.slots():
+                    subprocess.check_call(
+                        command, cwd=cargo_cwd,
+                        **jobserver.subprocess_args())
+            except subprocess.CalledProcessError as e:
+                print(f"ERROR: Cargo failed with return code {e.returncode}")
+                sys.exit(1)
+            except FileNotFoundError:
+                print("ERROR: 'cargo' command not found. Is Rust installed?")
+                sys.exit(1)
+
+    def run_cargo_json(self, command, cargo_cwd, jobserver, on_message,
+                       on_start=None):
+        """
+        Run cargo with JSON messages on stdout, passing each to on_message
+        as it arrives. Rendered diagnostics still go to stderr. on_start is
+        called once cargo is running.
+        """
+        with jobserver.slots():
+            try:
+                process = subprocess.Popen(
+                    command,
+                    cwd=cargo_cwd,
+                    stdout=subprocess.PIPE,
+                    text=True,
+                    **jobserver.subprocess_args()
+                )
+            except FileNotFoundError:
+                print("ERROR: 'cargo' command not found. Is Rust installed?")
+                sys.exit(1)
+            if on_start is not None:
+                on_start()
+
+            with process:
+                for line in process.stdout:
+                    if not line.startswith("{"):
+                        # e.g. output from the tool a cargo subcommand runs
+                        print(line, end="")
+                        continue
+                    on_message(json.loads(line))
+
+        if process.returncode != 0:
+            print(f"ERROR: Cargo failed with return code {process.returncode}")
             sys.exit(1)
+
+    def write_timings(self, files_root, project_dir, workspaces):
+        """
+        Write one report per cargo workspace to timings_path (relative to
+        project_dir). workspaces maps each workspace root to its timings.
+        Reports for workspaces not built this time are kept.
+        """
+        timings_path = files_root / project_dir / self.config.get(
+            "timings_path", "target/cargo-timings.json")
+        threshold = float(self.config.get("timings_threshold", 20)) / 100.0
+
+        timings_path.parent.mkdir(parents=True, exist_ok=True)
+        with output_lock(timings_path):
+            reports = {}
+            if timings_path.is_file():
+                reports = json.loads(
+                    timings_path.read_text()).get("workspaces", {})
+
+            for root, timings in workspaces.items():
+                name = os.path.relpath(root.resolve(), files_root.resolve())
+                name = Path(name).as_posix()
+                reports[name] = timings.report(reports.get(name), threshold)
+                print_report(reports[name], name)
+
+            write_text_atomic(
+                timings_path,
+                json.dumps({"workspaces": reports}, indent=2) + "\n")
+        print(f"Cargo timings: {timings_path.resolve().as_posix()}")
+
+    def parse_images(self, files_root, project_dir, images):
+        parsed = []
+        for image in images:
+            if isinstance(image, str):
+                image = {"package": image}
+            package = image.get("package")
+            if not package:
+                print(f"ERROR: Image is missing 'package': {image}")
+                sys.exit(1)
+            image_project_path = files_root / image.get(
+                "project_dir", project_dir)
+            if not (image_project_path / "Cargo.toml").exists():
+                print(f"ERROR: Cargo.toml not found in {image_project_path}")
+                sys.exit(1)
+            parsed.append({
+                "package": package,
+                "bin": image.get("bin", package),
+                "project_path": image_project_path,
+                "output": image.get("output"),
+            })
+        return parsed
+
+    def find_workspace_root(self, project_path):
+        try:
+            result = subprocess.run(
+                ["cargo", "locate-project", "--workspace",
+                 "--message-format", "plain"],
+                cwd=project_path,
+                capture_output=True,
+                text=True
+            )
         except FileNotFoundError:
             print("ERROR: 'cargo' command not found. Is Rust installed?")
             sys.exit(1)
+        if result.returncode != 0:
+            print(f"ERROR: Unable to find the cargo workspace of "
+                  f"{project_path}")
+            print(result.stderr.strip())
+            sys.exit(1)
+        return Path(result.stdout.strip()).parent.resolve()
+
+    def group_images(self, images):
+        """
+        Group images by the cargo workspace their project belongs to. Each
+        group is built by one cargo invocation. Separate workspaces can't
+        share one: cargo requires workspace members to be below the
+        workspace root, and only reads .cargo/config.toml from there.
+        """
+        roots = {}
+        groups = {}
+        for image in images:
+            project_path = image["project_path"].resolve()
+            if project_path not in roots:
+                roots[project_path] = self.find_workspace_root(project_path)
+            groups.setdefault(roots[project_path], []).append(image)
+
+        for root, group in groups.items():
+            bins = [image["bin"] for image in group]
+            duplicates = sorted({b for b in bins if bins.count(b) > 1})
+            if duplicates:
+                print(f"ERROR: Binaries built more than once in {root}: "
+                      f"{duplicates}")
+                sys.exit(1)
+        return groups
+
+    def build_images(self, cargo_cwd, images, args, jobserver, timings):
+        """
+        Build every image's binary in one cargo invocation, so dependencies
+        and build scripts are only resolved and compiled once. Returns the
+        ELF path of each binary, from cargo's artifact messages.
+        """
+        packages = sorted({image["package"] for image in images})
+        json_timings = timings is not None and supports_json_timings(cargo_cwd)
+        command = ["cargo", "build"] + cargo_options(json_timings)
+        for package in packages:
+            command += ["-p", package]
+        for image in images:
+            command += ["--bin", image["bin"]]
+        command += args
+
+        print(f"Running cargo in: {cargo_cwd}")
+        print(f"Command: {' '.join(command)}")
+
+        executables = {}
+
+        def on_message(message):
+            if timings is not None:
+                timings.add_message(message)
+            if message.get("reason") != "compiler-artifact":
+                return
+            executable = message.get("executable")
+            if executable and "bin" in message["target"]["kind"]:
+                executables[message["target"]["name"]] = Path(executable)
+
+        on_start = timings.start_clock if timings is not None else None
+        self.run_cargo_json(
+            command, cargo_cwd, jobserver, on_message, on_start)
+
+        missing = [i["bin"] for i in images if i["bin"] not in executables]
+        if missing:
+            print(f"ERROR: Cargo did not produce binaries: {missing}")
+            sys.exit(1)
+        return executables
+
+    def objcopy_image(self, jobserver, command, elf_path, output_path):
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = output_path.with_name(
+            f".{output_path.name}.tmp-{os.getpid()}")
+        with jobserver.slots():
+            result = subprocess.run(
+                command + [elf_path.as_posix(), tmp_path.as_posix()],
+                capture_output=True
+            )
+        if result.returncode != 0:
+            tmp_path.unlink(missing_ok=True)
+            return result.stderr.decode(errors="replace")
+        os.replace(tmp_path, output_path)
+        return None
+
+    def build_group(self, workspace_root, images, args, jobserver, profile,
+                    command, objcopy_executor):
+        """
+        Build one workspace's images, then extract them in parallel.
+        Returns each image's output path and objcopy error (or None), and
+        the build's timings (or None).
+        """
+        timings = CargoTimings() if profile else None
+        with output_lock(workspace_root / "target"):
+            executables = self.build_images(
+                workspace_root, images, args, jobserver, timings)
+
+            elf_paths = [executables[image["bin"]] for image in images]
+            output_paths = []
+            for image, elf_path in zip(images, elf_paths):
+                if image["output"]:
+                    output_paths.append(
+                        image["project_path"] / image["output"])
+                else:
+                    output_paths.append(elf_path.with_name(
+                        f"{elf_path.name}.bin"))
+
+            futures = [
+                objcopy_executor.submit(
+                    self.objcopy_image, jobserver, command, *paths)
+                for paths in zip(elf_paths, output_paths)
+            ]
+            errors = [future.result() for future in futures]
+
+        return output_paths, errors, timings
+
+    def run_images(self, files_root, project_dir, images, args, profile):
+        images = self.parse_images(files_root, project_dir, images)
+        objcopy = self.config.get("objcopy", "rust-objcopy")
+        objcopy_args = self.config.get("objcopy_args", ["-O", "binary"])
+
+        if shutil.which(objcopy) is None:
+            print(f"ERROR: '{objcopy}' command not found. "
+                  "Is cargo-binutils installed?")
+            sys.exit(1)
+
+        groups = self.group_images(images)
+
+        # workspaces build concurrently, with one objcopy per job slot from
+        # the build's jobserver
+        jobserver = get_jobserver()
+        command = [objcopy] + objcopy_args
+        workers = getattr(jobserver, "jobs", None) or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=workers) as objcopy_executor, \
+                ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            futures = {
+                root: executor.submit(
+                    self.build_group, root, group, args, jobserver,
+                    profile, command, objcopy_executor)
+                for root, group in groups.items()
+            }
+            results = {root: f.result() for root, f in futures.items()}
+
+        built = []
+        failed = []
+        if profile:
+            self.write_timings(files_root, project_dir, {
+                root: result[2] for root, result in results.items()})
+
+        for root, group in groups.items():
+            output_paths, errors, _ = results[root]
+            for image, output_path, error in zip(group, output_paths, errors):
+                if error is not None:
+                    failed.append((image, error))
+                built.append((image, output_path))
+        built.sort(key=lambda item: images.index(item[0]))
+        if failed:
+            print(f"ERROR: {objcopy} failed")
+            for image, error in failed:
+                print(f"({image['bin']}) {error}")
+            sys.exit(1)
+
+        for image, output_path in built:
+            print(f"[{image['bin']}] {output_path.resolve().as_posix()}")
 
+        self.add_files(
+            [path.resolve().as_posix() for _, path in built],
+            fileset="firmware",
+            file_type="user"
+        )
 
 if __name__ == "__main__":
     generator = CargoGen()
     generator.run()
+    generator.write()
@@ -0,0 +1,227 @@
+#                           /$$
+#                          |__/
+#        /$$$$$$$  /$$$$$$  /$$ /$$$$$$$  /$$   /$$
+#       /$$_____/ /$$__  $$| $$| $$__  $$| $$  | $$
+#      |  $$$$$$ | $$  \ $$| $$| $$  \ $$| $$  | $$   (c) Craig J Bishop
+#       \____  $$| $$  | $$| $$| $$  | $$| $$  | $$   All rights reserved
+#       /$$$$$$$/| $$$$$$$/| $$| $$  | $$|  $$$$$$$
+#      |_______/ | $$____/ |__/|__/  |__/ \____  $$   MIT License
+#                | $$                     /$$  | $$
+#                | $$                    |  $$$$$$/
+#                |__/                     \______/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+# NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+# USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+"""
+Per-crate compile-time profiling from cargo's JSON messages
+
+Cargo's messages are parsed as they stream in. On nightly toolchains, cargo
+also reports the duration of every compilation unit (`--timings=json`).
+Elsewhere, a unit's duration is estimated as the time since the previous
+unit finished (or since cargo started). That is only accurate for serial
+builds: with parallel jobs, units that finish close together each get a
+short slice, and a unit's own time includes waiting on others.
+
+The report records each crate's compile time, build-script time, and
+whether it was fresh or rebuilt. The last build time of fresh crates is
+carried forward from the previous report, so regressions are always
+measured against the last time a crate was actually compiled. Estimated
+times are reported but never flagged as regressions.
+"""
+
+import re
+import time
+import subprocess
+
+
+PACKAGE_ID_RE = re.compile(r"#(?:(?P<name>[^@]+)@)?(?P<version>[^#@]+)$")
+
+
+def parse_package_id(package_id):
+    """Crate name and version from both old and new package ID formats"""
+    # new: "path+file:///fw/app#0.1.0", "registry+https://...#riscv@0.16.0"
+    match = PACKAGE_ID_RE.search(package_id)
+    if match:
+        name = match.group("name")
+        if name is None:
+            source = package_id[:match.start()].split("?")[0]
+            name = source.rstrip("/").rsplit("/", 1)[-1]
+        return name, match.group("version")
+    # old: "riscv 0.16.0 (registry+https://...)"
+    name, version = package_id.split(" ")[:2]
+    return name, version
+
+
+def supports_json_timings(cargo_cwd):
+    """Unit timings need a nightly cargo (honours rust-toolchain files)"""
+    try:
+        version = subprocess.run(
+            ["cargo", "--version"], cwd=cargo_cwd,
+            capture_output=True, text=True).stdout
+    except FileNotFoundError:
+        return False
+    return "-nightly" in version or "-dev" in version
+
+
+def cargo_options(json_timings):
+    options = ["--message-format=json-render-diagnostics"]
+    if json_timings:
+        options += ["-Zunstable-options", "--timings=json"]
+    return options
+
+
+class CargoTimings:
+    def __init__(self):
+        self.start_clock()
+        self.crates = {}
+        self.estimated = True
+
+    def start_clock(self):
+        """Start timing, when cargo itself starts (not when queued)"""
+        self.start = time.monotonic()
+        self.last_finish = self.start
+
+    def crate(self, package_id):
+        name, version = parse_package_id(package_id)
+        key = f"{name} {version}"
+        if key not in self.crates:
+            self.crates[key] = {
+                "name": name,
+                "version": version,
+                "fresh": True,
+                "compile_seconds": 0.0,
+                "build_script_seconds": 0.0,
+            }
+        return self.crates[key]
+
+    def elapsed(self):
+        """Time since the previous unit finished"""
+        now = time.monotonic()
+        seconds = now - self.last_finish
+        self.last_finish = now
+        return seconds
+
+    def add_message(self, message):
+        reason = message.get("reason")
+        if reason == "timing-info":
+            # exact unit durations replace the estimates from here on
+            if self.estimated:
+                self.estimated = False
+                for crate in self.crates.values():
+                    crate["compile_seconds"] = 0.0
+                    crate["build_script_seconds"] = 0.0
+            crate = self.crate(message["package_id"])
+            if (message.get("mode") == "run-custom-build"
+                    or "custom-build" in message["target"]["kind"]):
+                crate["build_script_seconds"] += message["duration"]
+            else:
+                crate["compile_seconds"] += message["duration"]
+
+        elif reason == "compiler-artifact":
+            crate = self.crate(message["package_id"])
+            if message.get("fresh"):
+                return
+            crate["fresh"] = False
+            seconds = self.elapsed()
+            if not self.estimated:
+                return
+            if "custom-build" in message["target"]["kind"]:
+                crate["build_script_seconds"] += seconds
+            else:
+                crate["compile_seconds"] += seconds
+
+        elif reason == "build-script-executed":
+            crate = self.crate(message["package_id"])
+            # fresh build scripts are replayed with no delay
+            seconds = self.elapsed()
+            if self.estimated and not crate["fresh"]:
+                crate["build_script_seconds"] += seconds
+
+    def report(self, previous, threshold):
+        """
+        Build the report, comparing against a previous report (or None).
+        Crates whose build time rose by more than `threshold` (a fraction)
+        and at least a second are flagged, when both times are exact.
+        """
+        previous_crates = {}
+        if previous:
+            previous_crates = {
+                f"{c['name']} {c['version']}": c for c in previous["crates"]}
+
+        crates = []
+        for key, crate in sorted(self.crates.items()):
+            crate = dict(crate)
+            crate["compile_seconds"] = round(crate["compile_seconds"], 3)
+            crate["build_script_seconds"] = round(
+                crate["build_script_seconds"], 3)
+            seconds = crate["compile_seconds"] + crate["build_script_seconds"]
+            previous_crate = previous_crates.get(key, {})
+            last = previous_crate.get("last_build_seconds")
+            last_estimated = previous_crate.get(
+                "last_build_estimated", (previous or {}).get("estimated", True))
+
+            crate["regressed"] = False
+            if crate["fresh"]:
+                crate["last_build_seconds"] = last
+                crate["last_build_estimated"] = last_estimated
+            else:
+                crate["last_build_seconds"] = round(seconds, 3)
+                crate["last_build_estimated"] = self.estimated
+                if last is not None:
+                    crate["previous_build_seconds"] = last
+                    crate["regressed"] = (
+                        not self.estimated and not last_estimated
+                        and seconds > last * (1.0 + threshold)
+                        and seconds - last >= 1.0)
+            crates.append(crate)
+
+        return {
+            "timestamp": time.time(),
+            "total_seconds": round(time.monotonic() - self.start, 3),
+            "estimated": self.estimated,
+            "crates": crates,
+        }
+
+
+def print_report(report, workspace, top=10):
+    rebuilt = [c for c in report["crates"] if not c["fresh"]]
+    fresh = len(report["crates"]) - len(rebuilt)
+    source = "unit timings"
+    if report["estimated"]:
+        source = "estimated, not checked for regressions"
+    print(f"Cargo build ({workspace}): {report['total_seconds']:.1f}s, "
+          f"{len(rebuilt)} crates rebuilt, {fresh} fresh ({source})")
+
+    rebuilt.sort(key=lambda c: c["last_build_seconds"], reverse=True)
+    for crate in rebuilt[:top]:
+        name = f"{crate['name']} {crate['version']}"
+        line = (f"  {name:<40} {crate['compile_seconds']:>8.2f}s"
+                f"  build script {crate['build_script_seconds']:>6.2f}s")
+        if crate["regressed"]:
+            line += f"  (was {crate['previous_build_seconds']:.2f}s)"
+        print(line)
+
+    for crate in report["crates"]:
+        if crate["regressed"]:
+            print(f"WARNING: {crate['name']} {crate['version']} build time "
+                  f"rose from {crate['previous_build_seconds']:.2f}s to "
+                  f"{crate['last_build_seconds']:.2f}s")
@@ -0,0 +1,401 @@
+#                           /$$
+#                          |__/
+#        /$$$$$$$  /$$$$$$  /$$ /$$$$$$$  /$$   /$$
+#       /$$_____/ /$$__  $$| $$| $$__  $$| $$  | $$
+#      |  $$$$$$ | $$  \ $$| $$| $$  \ $$| $$  | $$   (c) Craig J Bishop
+#       \____  $$| $$  | $$| $$| $$  | $$| $$  | $$   All rights reserved
+#       /$$$$$$$/| $$$$$$$/| $$| $$  | $$|  $$$$$$$
+#      |_______/ | $$____/ |__/|__/  |__/ \____  $$   MIT License
+#                | $$                     /$$  | $$
+#                | $$                    |  $$$$$$/
+#                |__/                     \______/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+# NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+# USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import sys
+import re
+import mmap
+import json
+import struct
+import time
+from pathlib import Path
+
+from fusesoc.capi2.generator import Generator
+
+from outputs import output_lock
+
+
+ELF_MAGIC = b"\x7fELF"
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHF_ALLOC = 0x2
+PT_LOAD = 1
+STT_OBJECT = 1
+STT_FUNC = 2
+
+# (header, section header, program header, symbol) layouts per ELF class
+ELF_LAYOUTS = {
+    ELFCLASS32: {
+        "header": "16sHHIIIIIHHHHHH",
+        "section": "IIIIIIIIII",
+        "program": "IIIIIIII",
+        "symbol": "IIIBBH",
+    },
+    ELFCLASS64: {
+        "header": "16sHHIQQQIHHHHHH",
+        "section": "IIQQQQIIQQ",
+        "program": "IIQQQQQQ",
+        "symbol": "IBBHQQ",
+    },
+}
+
+MEMORY_REGION_RE = re.compile(
+    r"(\w+)\s*(?:\([^)]*\))?\s*:\s*"
+    r"ORIGIN\s*=\s*(0x[0-9a-fA-F]+|\d+)\s*,\s*"
+    r"LENGTH\s*=\s*(0x[0-9a-fA-F]+|\d+)\s*([KM]?)"
+)
+
+# riscv-rt sizes the stack section to fill the rest of its region, so it is
+# reported as free space instead of usage
+STACK_SECTIONS = [".stack"]
+
+LEGACY_HASH_RE = re.compile(r"^h[0-9a-f]{16}$")
+
+
+def demangle(name):
+    """
+    Best-effort demangling of legacy Rust symbol names, so that
+    `_ZN6blinky4main17h0123456789abcdefE` is reported as `blinky::main`
+    """
+    if not (name.startswith("_ZN") and name.endswith("E")):
+        return name
+
+    parts = []
+    rest = name[3:-1]
+    while rest:
+        match = re.match(r"^(\d+)", rest)
+        if not match:
+            return name
+        length = int(match.group(1))
+        start = len(match.group(1))
+        parts.append(rest[start:start + length])
+        rest = rest[start + length:]
+
+    if parts and LEGACY_HASH_RE.match(parts[-1]):
+        parts = parts[:-1]
+    return "::".join(parts).replace("$LT$", "<").replace("$GT$", ">") \
+        .replace("$u20$", " ").replace("$C$", ",").replace("..", "::")
+
+
+def parse_memory_regions(memory_x_text):
+    """
+    Parse the regions from the MEMORY block of a linker script,
+    as generated by SpinySoC.dumpLinkerScript
+    """
+    multipliers = {"": 1, "K": 1024, "M": 1024 * 1024}
+    regions = []
+    for name, origin, length, suffix in \
+            MEMORY_REGION_RE.findall(memory_x_text):
+        regions.append({
+            "name": name,
+            "origin": int(origin, 0),
+            "length": int(length, 0) * multipliers[suffix],
+        })
+    return regions
+
+
+def read_elf(elf_path):
+    """
+    Read allocated sections and sized symbols from an ELF file
+    via a memory map, without relying on external binutils
+    """
+    with open(elf_path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:4] != ELF_MAGIC:
+                print(f"ERROR: Not an ELF file: {elf_path}")
+                sys.exit(1)
+
+            elf_class = data[4]
+            elf_data = data[5]
+            if elf_class not in ELF_LAYOUTS or \
+                    elf_data not in (ELFDATA2LSB, ELFDATA2MSB):
+                print(f"ERROR: Unsupported ELF class or encoding: {elf_path}")
+                sys.exit(1)
+
+            endian = "<" if elf_data == ELFDATA2LSB else ">"
+            layout = {
+                k: struct.Struct(endian + v)
+                for k, v in ELF_LAYOUTS[elf_class].items()
+            }
+
+            (_, _, _, _, _, e_phoff, e_shoff, _, _, e_phentsize, e_phnum,
+             e_shentsize, e_shnum, e_shstrndx) = \
+                layout["header"].unpack_from(data, 0)
+
+            def read_str(offset):
+                end = data.find(b"\0", offset)
+                return data[offset:end].decode("utf-8", errors="replace")
+
+            raw_sections = [
+                layout["section"].unpack_from(data, e_shoff + i * e_shentsize)
+                for i in range(e_shnum)
+            ]
+            shstr_offset = raw_sections[e_shstrndx][4] if raw_sections else 0
+
+            # load segments map virtual (run) to physical (load) addresses
+            segments = []
+            for i in range(e_phnum):
+                (p_type, p_vaddr, p_paddr, p_memsz) = read_program_header(
+                    layout["program"], data, e_phoff + i * e_phentsize,
+                    elf_class)
+                if p_type == PT_LOAD:
+                    segments.append((p_vaddr, p_paddr, p_memsz))
+
+            sections = []
+            symtab = None
+            for raw in raw_sections:
+                (sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size,
+                 sh_link, _, _, sh_entsize) = raw
+                if sh_type == SHT_SYMTAB:
+                    symtab = raw
+                if not (sh_flags & SHF_ALLOC) or sh_size == 0:
+                    continue
+
+                load_addr = sh_addr
+                for vaddr, paddr, memsz in segments:
+                    if vaddr <= sh_addr < vaddr + memsz:
+                        load_addr = sh_addr - vaddr + paddr
+                        break
+
+                sections.append({
+                    "name": read_str(shstr_offset + sh_name),
+                    "address": sh_addr,
+                    "load_address": load_addr,
+                    "size": sh_size,
+                    "nobits": sh_type == SHT_NOBITS,
+                })
+
+            symbols = []
+            if symtab is not None:
+                (_, _, _, _, sym_offset, sym_size, sym_link, _, _,
+                 sym_entsize) = symtab
+                str_offset = raw_sections[sym_link][4]
+                for i in range(sym_size // sym_entsize):
+                    name, value, size, info = read_symbol(
+                        layout["symbol"], data, sym_offset + i * sym_entsize,
+                        elf_class)
+                    if size == 0 or (info & 0xf) not in (STT_OBJECT, STT_FUNC):
+                        continue
+                    symbols.append({
+                        "name": demangle(read_str(str_offset + name)),
+                        "address": value,
+                        "size": size,
+                    })
+
+            return sections, symbols
+
+
+def read_program_header(fmt, data, offset, elf_class):
+    fields = fmt.unpack_from(data, offset)
+    if elf_class == ELFCLASS32:
+        p_type, _, p_vaddr, p_paddr, _, p_memsz, _, _ = fields
+    else:
+        p_type, _, _, p_vaddr, p_paddr, _, p_memsz, _ = fields
+    return p_type, p_vaddr, p_paddr, p_memsz
+
+
+def read_symbol(fmt, data, offset, elf_class):
+    fields = fmt.unpack_from(data, offset)
+    if elf_class == ELFCLASS32:
+        st_name, st_value, st_size, st_info, _, _ = fields
+    else:
+        st_name, st_info, _, _, st_value, st_size = fields
+    return st_name, st_value, st_size, st_info
+
+
+def find_region(regions, address):
+    for region in regions:
+        if region["origin"] <= address < region["origin"] + region["length"]:
+            return region
+    return None
+
+
+def compute_region_usage(sections, regions):
+    """
+    Sum up section sizes per memory region. Sections with a different load
+    address (e.g. .data copied from ROM) count against both regions.
+    The stack is left out, since it takes whatever space remains.
+    Returns the usage per region and any sections that do not fit, as
+    (section, address, region) with region None if it is in no region.
+    """
+    usage = {region["name"]: 0 for region in regions}
+    misplaced = []
+    for section in sections:
+        if section["name"] in STACK_SECTIONS:
+            continue
+        addresses = [section["address"]]
+        if not section["nobits"] and \
+                section["load_address"] != section["address"]:
+            addresses.append(section["load_address"])
+
+        for address in addresses:
+            region = find_region(regions, address)
+            end = address + section["size"]
+            if region is None or \
+                    end > region["origin"] + region["length"]:
+                misplaced.append((section, address, region))
+            if region is not None:
+                usage[region["name"]] += section["size"]
+    return usage, misplaced
+
+
+def load_previous_entry(history_path, elf_name):
+    if not history_path.is_file():
+        return None
+    previous = None
+    for line in history_path.read_text().splitlines():
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if entry.get("elf") == elf_name:
+            previous = entry
+    return previous
+
+
+def format_delta(current, previous):
+    if previous is None:
+        return ""
+    delta = current - previous
+    if delta == 0:
+        return ""
+    return f" ({delta:+d})"
+
+
+class ElfSizeGen(Generator):
+    def run(self):
+        elf_path = self.config.get("elf_path")
+        memory_x_path = self.config.get("memory_x_path")
+        top_symbols = int(self.config.get("top_symbols", 10))
+        history_path = self.config.get("history_path")
+
+        missing_parameter = False
+        if not elf_path:
+            print("ERROR: 'elf_path' is a required parameter")
+            missing_parameter = True
+        if not memory_x_path:
+            print("ERROR: 'memory_x_path' is a required parameter")
+            missing_parameter = True
+        if missing_parameter:
+            sys.exit(1)
+
+        files_root = Path(self.files_root)
+        elf_path = files_root / elf_path
+        memory_x_path = files_root / memory_x_path
+        # not next to the ELF by default: cargo clean would delete it
+        history_path = files_root / (history_path or "size_history.jsonl")
+
+        if not elf_path.is_file():
+            print("ERROR: ELF input does not exist or is not a file")
+            print(f"(expected here: {elf_path.resolve().as_posix()})")
+            sys.exit(1)
+        if not memory_x_path.is_file():
+            print("ERROR: Linker script does not exist or is not a file")
+            print(f"(expected here: {memory_x_path.resolve().as_posix()})")
+            sys.exit(1)
+
+        regions = parse_memory_regions(memory_x_path.read_text())
+        if not regions:
+            print(f"ERROR: No MEMORY regions found in {memory_x_path}")
+            sys.exit(1)
+
+        sections, symbols = read_elf(elf_path)
+        usage, misplaced = compute_region_usage(sections, regions)
+        previous = load_previous_entry(history_path, elf_path.name)
+        prev_sections = previous["sections"] if previous else {}
+        prev_regions = previous["regions"] if previous else {}
+
+        elf_name = elf_path.name
+        print(f"[{elf_name}] Sections:")
+        for section in sections:
+            name = section["name"]
+            delta = format_delta(section["size"], prev_sections.get(name))
+            print(f"  {name:<24} 0x{section['address']:08x} "
+                  f"{section['size']:>10}{delta}")
+
+        print(f"[{elf_name}] Memory regions:")
+        overflow = False
+        for region in regions:
+            name = region["name"]
+            used = usage[name]
+            length = region["length"]
+            percent = 100.0 * used / length if length else 0.0
+            delta = format_delta(used, prev_regions.get(name))
+            print(f"  {name:<24} {used:>10} / {length:<10} "
+                  f"({percent:5.1f}%){delta}")
+            if used > length:
+                overflow = True
+
+        if top_symbols > 0:
+            print(f"[{elf_name}] Top {top_symbols} symbols:")
+            largest = sorted(symbols, key=lambda s: s["size"], reverse=True)
+            for symbol in largest[:top_symbols]:
+                print(f"  {symbol['size']:>10}  {symbol['name']}")
+
+        # one line per run, appended under the lock so concurrent builds
+        # can't interleave their entries
+        with output_lock(history_path), open(history_path, "a") as f:
+            f.write(json.dumps({
+                "timestamp": time.time(),
+                "elf": elf_name,
+                "sections": {s["name"]: s["size"] for s in sections},
+                "regions": usage,
+            }) + "\n")
+
+        if overflow or misplaced:
+            print(f"ERROR: Firmware does not fit in memory: {elf_path}")
+            for region in regions:
+                used = usage[region["name"]]
+                if used > region["length"]:
+                    print(f"       {region['name']} overflowed by "
+                          f"{used - region['length']} bytes "
+                          f"({used} used, {region['length']} available)")
+            for section, address, region in misplaced:
+                description = (f"       {section['name']} "
+                               f"(0x{address:08x}, {section['size']} bytes)")
+                if region is None:
+                    print(f"{description} is not in any memory region")
+                else:
+                    past = (address + section["size"]
+                            - region["origin"] - region["length"])
+                    print(f"{description} extends {past} bytes past "
+                          f"{region['name']}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    generator = ElfSizeGen()
+    generator.run()
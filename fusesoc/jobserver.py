@@ -0,0 +1,309 @@
+#                           /$$
+#                          |__/
+#        /$$$$$$$  /$$$$$$  /$$ /$$$$$$$  /$$   /$$
+#       /$$_____/ /$$__  $$| $$| $$__  $$| $$  | $$
+#      |  $$$$$$ | $$  \ $$| $$| $$  \ $$| $$  | $$   (c) Craig J Bishop
+#       \____  $$| $$  | $$| $$| $$  | $$| $$  | $$   All rights reserved
+#       /$$$$$$$/| $$$$$$$/| $$| $$  | $$|  $$$$$$$
+#      |_______/ | $$____/ |__/|__/  |__/ \____  $$   MIT License
+#                | $$                     /$$  | $$
+#                | $$                    |  $$$$$$/
+#                |__/                     \______/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+# NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+# USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+GNU make compatible jobserver shared by Spiny's generators
+
+A build is run under a jobserver that holds a fixed core budget:
+
+    python3 fusesoc/jobserver.py -j 8 -- fusesoc run --build ...
+
+The jobserver is a named FIFO, advertised to generators through the
+SPINY_JOBSERVER environment variable (FuseSoC starts generators with
+close_fds, so an inherited pipe would not reach them). Generators pass it
+on to make and cargo as pipe file descriptors, which both understand, and
+take tokens for their own parallel workers (rustfmt, LiteDRAM sweeps, JVM
+elaboration). If the build already runs under a make jobserver, that one
+is used instead.
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import shutil
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+
+
+JOBSERVER_ENV = "SPINY_JOBSERVER"
+JOBSERVER_AUTH_RE = re.compile(r"--jobserver-(?:auth|fds)=(\S+)")
+JOBS_RE = re.compile(r"(?:^|\s)-j\s*(\d+)")
+TOKEN = b"+"
+NO_TOKEN = object()
+
+
+class Jobserver:
+    """
+    Client for a make jobserver. A process started by make as a job owns
+    one implicit job slot, and reads a token from the jobserver for every
+    additional job. Spiny's own jobserver holds a token for every job, so
+    its clients have no implicit slot, and any number of generators
+    running at once stay within the budget.
+    """
+
+    def __init__(self, read_fd, write_fd, jobs=None, implicit_slot=True,
+                 fifo_path=None):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.jobs = jobs
+        self.fifo_path = fifo_path
+        self.lock = threading.Lock()
+        self.implicit_free = implicit_slot
+        self.nonblocking_read_fd = None
+
+    @classmethod
+    def from_fifo(cls, fifo_path, jobs=None, implicit_slot=True):
+        fd = os.open(fifo_path, os.O_RDWR)
+        return cls(fd, fd, jobs, implicit_slot, fifo_path)
+
+    def acquire(self):
+        with self.lock:
+            if self.implicit_free:
+                self.implicit_free = False
+                return None
+        return os.read(self.read_fd, 1)
+
+    def try_acquire(self):
+        """Take a slot without waiting, or return NO_TOKEN"""
+        with self.lock:
+            if self.implicit_free:
+                self.implicit_free = False
+                return None
+        try:
+            token = os.read(self.nonblocking_fd(), 1)
+        except BlockingIOError:
+            return NO_TOKEN
+        return token or NO_TOKEN
+
+    def nonblocking_fd(self):
+        # a separate open of the same pipe, so other threads' blocking
+        # reads on the shared descriptor are unaffected
+        with self.lock:
+            if self.nonblocking_read_fd is None:
+                path = self.fifo_path or f"/proc/self/fd/{self.read_fd}"
+                self.nonblocking_read_fd = os.open(
+                    path, os.O_RDONLY | os.O_NONBLOCK)
+            return self.nonblocking_read_fd
+
+    def release(self, token):
+        if token is None:
+            with self.lock:
+                self.implicit_free = True
+        else:
+            os.write(self.write_fd, token)
+
+    def acquire_all(self, count):
+        """
+        Take `count` slots all or nothing. Clients that each held some of
+        the slots they need while waiting for the rest would deadlock.
+        """
+        delay = 0.01
+        while True:
+            tokens = [self.acquire()]
+            while len(tokens) < count:
+                try:
+                    token = self.try_acquire()
+                except OSError:
+                    # no way to poll the jobserver, so settle for one slot
+                    return tokens
+                if token is NO_TOKEN:
+                    break
+                tokens.append(token)
+            if len(tokens) == count:
+                return tokens
+
+            for token in tokens:
+                self.release(token)
+            time.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, 1.0)
+
+    @contextmanager
+    def slots(self, count=1):
+        """Hold `count` job slots (including the implicit one if free)"""
+        # without a known budget, more slots than exist would never arrive
+        count = min(count, self.jobs) if self.jobs else 1
+        tokens = self.acquire_all(count)
+        try:
+            yield
+        finally:
+            for token in tokens:
+                self.release(token)
+
+    def subprocess_args(self, base_env=None):
+        """
+        Keyword arguments for starting make or cargo as jobserver clients,
+        passing the jobserver as pipe file descriptors (make >= 4.2).
+        Hold a slot while they run, since they take an implicit slot for
+        their first job.
+        """
+        env = dict(os.environ if base_env is None else base_env)
+        jobs = f"-j{self.jobs} " if self.jobs else ""
+        makeflags = (f" {jobs}--jobserver-auth="
+                     f"{self.read_fd},{self.write_fd}")
+        env["MAKEFLAGS"] = makeflags
+        env["CARGO_MAKEFLAGS"] = makeflags
+        return {
+            "env": env,
+            "pass_fds": tuple({self.read_fd, self.write_fd}),
+        }
+
+
+class LocalSlots:
+    """Fallback when there is no jobserver: limit to this machine's CPUs"""
+
+    def __init__(self, jobs=None):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.semaphore = threading.BoundedSemaphore(self.jobs)
+
+    def acquire(self):
+        self.semaphore.acquire()
+
+    def release(self, token):
+        self.semaphore.release()
+
+    @contextmanager
+    def slots(self, count=1):
+        count = min(count, self.jobs)
+        for _ in range(count):
+            self.semaphore.acquire()
+        try:
+            yield
+        finally:
+            for _ in range(count):
+                self.semaphore.release()
+
+    def subprocess_args(self, base_env=None):
+        return {"env": dict(os.environ if base_env is None else base_env)}
+
+
+def parse_makeflags(makeflags):
+    """Returns the (auth, jobs) of a jobserver in MAKEFLAGS, if any"""
+    auth = JOBSERVER_AUTH_RE.findall(makeflags)
+    if not auth:
+        return None, None
+    jobs = JOBS_RE.findall(makeflags)
+    return auth[-1], int(jobs[-1]) if jobs else None
+
+
+def connect(auth, jobs, implicit_slot=True):
+    """Connect to a FIFO (fifo:PATH) or inherited pipe (R,W) jobserver"""
+    if auth.startswith("fifo:"):
+        fifo_path = auth[len("fifo:"):]
+        if not os.path.exists(fifo_path):
+            return None
+        try:
+            return Jobserver.from_fifo(fifo_path, jobs, implicit_slot)
+        except OSError:
+            print(f"WARNING: Unable to open jobserver: {fifo_path}")
+            return None
+
+    try:
+        read_fd, write_fd = (int(fd) for fd in auth.split(","))
+        os.fstat(read_fd)
+        os.fstat(write_fd)
+    except (ValueError, OSError):
+        # pipe was not inherited by this process
+        return None
+    return Jobserver(read_fd, write_fd, jobs, implicit_slot)
+
+
+def get_jobserver():
+    """
+    Connect to the build's jobserver from the environment, or fall back
+    to a local CPU count limit
+    """
+    for var in (JOBSERVER_ENV, "CARGO_MAKEFLAGS", "MAKEFLAGS", "MFLAGS"):
+        auth, jobs = parse_makeflags(os.environ.get(var, ""))
+        if auth:
+            # generators aren't started as make jobs by Spiny's jobserver
+            implicit_slot = var != JOBSERVER_ENV
+            jobserver = connect(auth, jobs, implicit_slot)
+            if jobserver is not None:
+                return jobserver
+    return LocalSlots()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Run a command under a jobserver with a core budget")
+    parser.add_argument("-j", "--jobs", type=int,
+        default=int(os.environ.get("SPINY_JOBS", os.cpu_count() or 1)),
+        help="Total job budget (default: $SPINY_JOBS or CPU count)")
+    parser.add_argument("command", nargs=argparse.REMAINDER,
+        help="Command to run (after --)")
+    args = parser.parse_args()
+
+    command = args.command
+    if command and command[0] == "--":
+        command = command[1:]
+    if not command:
+        print("ERROR: No command given")
+        sys.exit(1)
+    if args.jobs < 1:
+        print("ERROR: --jobs must be at least 1")
+        sys.exit(1)
+
+    if not isinstance(get_jobserver(), LocalSlots):
+        print("Reusing existing jobserver")
+        sys.exit(subprocess.call(command))
+
+    tmp_dir = tempfile.mkdtemp(prefix="spiny-jobserver-")
+    try:
+        fifo_path = os.path.join(tmp_dir, "fifo")
+        os.mkfifo(fifo_path, 0o600)
+
+        # the command itself (e.g. fusesoc) runs no jobs, so every job,
+        # in every generator, takes a token
+        jobserver = Jobserver.from_fifo(fifo_path, args.jobs)
+        os.write(jobserver.write_fd, TOKEN * args.jobs)
+
+        env = dict(os.environ)
+        env[JOBSERVER_ENV] = f"-j{args.jobs} --jobserver-auth=fifo:{fifo_path}"
+        try:
+            returncode = subprocess.call(command, env=env)
+        except FileNotFoundError:
+            print(f"ERROR: '{command[0]}' command not found")
+            returncode = 1
+        os.close(jobserver.read_fd)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    sys.exit(returncode)
+
+
+if __name__ == "__main__":
+    main()
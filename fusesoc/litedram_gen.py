@@ -29,14 +29,26 @@
 # OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
 # USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import os
+import re
 import sys
+import copy
+import json
+import time
 import yaml
+import hashlib
+import itertools
 import subprocess
 from pathlib import Path
 from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
 
 from fusesoc.capi2.generator import Generator
 
+from jobserver import get_jobserver, LocalSlots
+from outputs import output_lock, staging_dir, publish_dir
+from remote import run_step
+
 from litedram import modules as litedram_modules
 from litedram.modules import (
     SDRModule, DDR2Module, DDR3Module, DDR4Module,
@@ -55,10 +67,21 @@ MODULE_BASE_CLASS_MAP = {
     "DDR4": DDR4Module,
 }
 
+# runs this script as litedram_gen, with a custom module registered
+LITEDRAM_GEN_ARG = "--litedram-gen"
+
 SUPPORTED_USER_PORT_TYPES = [
     "native"
 ]
 
+# matches Verilog reg declarations, including memories, e.g.
+# `reg [31:0] mem[0:15];` (width from the first range, depth from the second)
+REG_DECL_RE = re.compile(
+    r"^\s*reg\s+(?:signed\s+)?(?:\[(\d+):(\d+)\]\s*)?\w+"
+    r"\s*(?:\[(\d+):(\d+)\])?",
+    re.MULTILINE
+)
+
 def err_req_param(param_name, container_name):
     print(f"ERROR: `{param_name}` is a required parameter "
           f"in {container_name}")
@@ -101,7 +124,7 @@ def validate_float(input, param_name, container_name):
 
 def validate_tuple_cycles_time(input, param_name, container_name):
     raw_value = input.get(param_name, None)
-    if value is None:
+    if raw_value is None:
         err_req_param(param_name, container_name)
         return None
 
@@ -143,10 +166,14 @@ def validate_geometry(geom_def):
 
 def validate_tech_timings(timings_def):
     tREFI = validate_float(timings_def, "tREFI", "timings")
-    tWTR = validate_tuple_cycles_time("tWTR", "timings")
-    tCCD = validate_tuple_cycles_time("tCCD", "timings")
-    tRRD = validate_tuple_cycles_time("tRRD", "timings")
-    tZQCS = validate_tuple_cycles_time("tZQCS", "timings")
+    tWTR = validate_tuple_cycles_time(
+        timings_def, "tWTR", "timings")
+    tCCD = validate_tuple_cycles_time(
+        timings_def, "tCCD", "timings")
+    tRRD = validate_tuple_cycles_time(
+        timings_def, "tRRD", "timings")
+    tZQCS = validate_tuple_cycles_time(
+        timings_def, "tZQCS", "timings")
 
     if None in [tREFI, tWTR, tCCD, tRRD, tZQCS]:
         sys.exit(1)
@@ -163,8 +190,10 @@ def validate_speedgrade_timings(timings_def):
     tRP = validate_float(timings_def, "tRP", "timings")
     tRCD = validate_float(timings_def, "tRCD", "timings")
     tWR = validate_float(timings_def, "tWR", "timings")
-    tRFC = validate_tuple_cycles_time("tRFC", "timings")
-    tFAW = validate_tuple_cycles_time("tFAW", "timings")
+    tRFC = validate_tuple_cycles_time(
+        timings_def, "tRFC", "timings")
+    tFAW = validate_tuple_cycles_time(
+        timings_def, "tFAW", "timings")
     tRAS = validate_float(timings_def, "tRAS", "timings")
 
     if None in [tRP, tRCD, tWR, tRFC, tFAW, tRAS]:
@@ -317,7 +346,347 @@ def translate_config(config):
     return litedram_config
 
 
+def core_output_paths(output_dir, litex_name):
+    return (
+        output_dir / "gateware" / f"{litex_name}.v",
+        output_dir / "gateware" / f"{litex_name}.xdc"
+    )
+
+
+def custom_module_def(config):
+    """
+    The definition a custom module class is created from, or None if the
+    config uses a built-in module
+    """
+    module_def = config.get("dram_module")
+    if not isinstance(module_def, dict):
+        return None
+    return {
+        "dram_module": module_def,
+        "type": config.get("type"),
+        "dram_geometry": config.get("dram_geometry"),
+    }
+
+
+def run_litedram_gen(litex_name, litedram_config, output_dir,
+                     config_path, sim, custom_module=None):
+    """
+    Run litedram_gen with a translated config, returning the paths to the
+    generated Verilog and constraints
+    """
+    verilog_path, xdc_path = core_output_paths(output_dir, litex_name)
+
+    config_path.write_text(yaml.dump(litedram_config))
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    if custom_module is None:
+        command = ["litedram_gen"]
+    else:
+        # a custom module class only exists in the process that created it,
+        # so run LiteDRAM's generator in a process that re-creates it
+        module_path = output_dir / "dram_module.json"
+        module_path.write_text(json.dumps(custom_module))
+        command = [
+            sys.executable, Path(__file__).resolve().as_posix(),
+            LITEDRAM_GEN_ARG, module_path.resolve().as_posix()
+        ]
+
+    command += [
+        "--no-compile",
+        "--name", litex_name,
+        "--output-dir", output_dir.resolve().as_posix(),
+        config_path.resolve().as_posix()
+    ]
+
+    if sim:
+        command.append("--sim")
+
+    log_file = output_dir / "litedram_gen.log"
+    with open(log_file, "w") as f:
+        try:
+            subprocess.check_call(command, stdout=f, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            print("ERROR: litedram_gen failed")
+            print(f"See log: {log_file.resolve().as_posix()}")
+            sys.exit(1)
+        except FileNotFoundError:
+            print("ERROR: litedram_gen command not found. "
+                    "Is litex installed and on PATH?")
+            sys.exit(1)
+
+    if not verilog_path.is_file():
+        print("ERROR: litedram_gen failed, output verilog not found:")
+        print(f"       {verilog_path.resolve().as_posix()}")
+        print(f"See log: {log_file.resolve().as_posix()}")
+        sys.exit(1)
+
+    if not sim and not xdc_path.is_file():
+        print("ERROR: litedram_gen failed, output constraints not found:")
+        print(f"       {xdc_path.resolve().as_posix()}")
+        print(f"See log: {log_file.resolve().as_posix()}")
+        sys.exit(1)
+
+    return verilog_path, xdc_path
+
+
+def litedram_gen_main(argv):
+    """
+    Run LiteDRAM's core generator (the litedram_gen command) in this
+    process, with a custom module class registered under its name
+    """
+    module_path, *gen_args = argv
+    custom_module = json.loads(Path(module_path).read_text())
+    geom = validate_geometry(custom_module["dram_geometry"])
+    custom_class = create_custom_module(
+        custom_module["dram_module"], custom_module["type"], geom)
+    setattr(litedram_modules, custom_class.__name__, custom_class)
+
+    from litedram.gen import main
+    sys.argv = ["litedram_gen"] + gen_args
+    main()
+
+
+def verilog_stats(verilog_path):
+    """
+    Estimate logic size from generated Verilog, without running synthesis
+    """
+    text = verilog_path.read_text()
+    reg_bits = 0
+    mem_bits = 0
+    for msb, lsb, depth_a, depth_b in REG_DECL_RE.findall(text):
+        width = abs(int(msb) - int(lsb)) + 1 if msb else 1
+        if depth_a:
+            mem_bits += width * (abs(int(depth_a) - int(depth_b)) + 1)
+        else:
+            reg_bits += width
+    return {
+        "lines": text.count("\n"),
+        "reg_bits": reg_bits,
+        "mem_bits": mem_bits,
+        "always_blocks": text.count("always @"),
+    }
+
+
+def set_config_value(config, key, value):
+    """Set a value in a nested config with a dotted key (e.g. a.b.c)"""
+    parts = key.split(".")
+    for i, part in enumerate(parts[:-1]):
+        config = config.setdefault(part, {})
+        if not isinstance(config, dict):
+            parent = ".".join(parts[:i + 1])
+            print(f"ERROR: Can't set `{key}`, since `{parent}` is not a map")
+            if parent == "dram_module":
+                print("       (only custom DRAM modules have timings)")
+            sys.exit(1)
+    config[parts[-1]] = value
+
+
+def expand_sweep(base_config, sweep):
+    """
+    Expand a sweep (dotted keys mapped to lists of values) into the full
+    grid of configs, returning a list of (point, config) tuples. The config
+    is None if a key can't be set.
+    """
+    keys = list(sweep.keys())
+    points = []
+    for values in itertools.product(*(sweep[k] for k in keys)):
+        point = dict(zip(keys, values))
+        config = copy.deepcopy(base_config)
+        try:
+            for key, value in point.items():
+                set_config_value(config, key, value)
+        except SystemExit:
+            config = None
+        points.append((point, config))
+    return points
+
+
+def config_hash(litex_name, litedram_config, custom_module, sim):
+    """
+    Cache key for a generated core. The custom module definition is included
+    since the translated config only refers to it by name.
+    """
+    key = {
+        "name": litex_name,
+        "config": litedram_config,
+        "dram_module": custom_module,
+        "sim": bool(sim),
+    }
+    encoded = json.dumps(key, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def run_remote_step(inputs, output_dir, args):
+    """
+    Generate a core into output_dir, as a step that can run on a remote
+    worker (see remote.py)
+    """
+    run_litedram_gen(
+        args["litex_name"], args["litedram_config"],
+        output_dir / "litex_build", output_dir / "litedram_config.yml",
+        args["sim"], args["custom_module"])
+
+
+def generate_core(litex_name, litedram_config, custom_module, core_dir, sim):
+    """
+    Generate a core into its cache directory, unless another build already
+    has. Work is staged in a private directory and published with a rename,
+    so concurrent builds never see a partial core.
+
+    Returns the core's stats, and whether this call generated it.
+    """
+    result_path = core_dir / "result.json"
+    with output_lock(core_dir):
+        if result_path.is_file():
+            return json.loads(result_path.read_text()), False
+
+        with staging_dir(core_dir) as staging_path:
+            start = time.monotonic()
+            run_step("litedram", {
+                "litex_name": litex_name,
+                "litedram_config": litedram_config,
+                "custom_module": custom_module,
+                "sim": bool(sim),
+            }, {}, staging_path)
+            verilog_path, _ = core_output_paths(
+                staging_path / "litex_build", litex_name)
+            stats = verilog_stats(verilog_path)
+            stats["seconds"] = round(time.monotonic() - start, 1)
+
+            (staging_path / "result.json").write_text(json.dumps(stats))
+            publish_dir(staging_path, core_dir)
+
+    return stats, True
+
+
+def print_sweep_table(keys, rows):
+    headers = keys + ["status", "lines", "reg_bits", "mem_bits", "seconds"]
+    table = [[str(row.get(h, "-")) for h in headers] for row in rows]
+    widths = [
+        max(len(h), *(len(r[i]) for r in table))
+        for i, h in enumerate(headers)
+    ]
+    print("  ".join(h.ljust(w) for h, w in zip(headers, widths)))
+    for r in table:
+        print("  ".join(v.ljust(w) for v, w in zip(r, widths)))
+
+
 class LiteDramGen(Generator):
+    def cache_dir(self):
+        return Path(self.files_root) / self.config.get(
+            "cache_dir", "target/litedram_cache")
+
+    def run_sweep(self, in_config, litex_name, sweep, sim):
+        if not isinstance(sweep, dict) or not sweep:
+            print("ERROR: `sweep` must map config keys to lists of values")
+            sys.exit(1)
+        for key, values in sweep.items():
+            if not isinstance(values, list) or not values:
+                print(f"ERROR: sweep values for `{key}` must be a "
+                      "non-empty list")
+                sys.exit(1)
+
+        cache_dir = self.cache_dir()
+        jobs = int(self.config.get("jobs", os.cpu_count() or 1))
+
+        # validate every point before generating anything
+        points = expand_sweep(in_config, sweep)
+        invalid = []
+        for point, config in points:
+            if config is None:
+                invalid.append(point)
+                continue
+            try:
+                litedram_config = translate_config(config)
+            except SystemExit:
+                invalid.append(point)
+                continue
+            except (TypeError, ValueError, KeyError, AttributeError) as e:
+                print(f"ERROR: {e}")
+                invalid.append(point)
+                continue
+            custom_module = custom_module_def(config)
+            point["hash"] = config_hash(
+                litex_name, litedram_config, custom_module, sim)
+            point["litedram_config"] = litedram_config
+            point["custom_module"] = custom_module
+        if invalid:
+            print(f"ERROR: {len(invalid)} of {len(points)} sweep points "
+                  "are invalid:")
+            for point in invalid:
+                print(f"       {point}")
+            sys.exit(1)
+
+        # identical translated configs are only generated once
+        to_generate = {}
+        for point, _ in points:
+            point_hash = point["hash"]
+            if (cache_dir / point_hash / "result.json").is_file():
+                point["status"] = "cached"
+            elif point_hash in to_generate:
+                point["status"] = "generated"
+            else:
+                point["status"] = "generated"
+                to_generate[point_hash] = (
+                    point["litedram_config"], point["custom_module"])
+
+        print(f"[{litex_name}] Sweep: {len(points)} points, "
+              f"{len(to_generate)} to generate with {jobs} workers")
+
+        # each point holds a job slot from the build's jobserver while
+        # it is generating. Without one, `jobs` is the only limit.
+        jobserver = get_jobserver()
+        if isinstance(jobserver, LocalSlots):
+            jobserver = LocalSlots(jobs)
+        failed = set()
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {}
+            for point_hash, config in to_generate.items():
+                litedram_config, custom_module = config
+                token = jobserver.acquire()
+                future = executor.submit(
+                    generate_core, litex_name, litedram_config,
+                    custom_module, cache_dir / point_hash, sim)
+                future.add_done_callback(
+                    lambda _, token=token: jobserver.release(token))
+                futures[point_hash] = future
+            reused = set()
+            for point_hash, future in futures.items():
+                try:
+                    _, generated = future.result()
+                except SystemExit:
+                    failed.add(point_hash)
+                    continue
+                if not generated:
+                    # another build generated it while this one waited
+                    reused.add(point_hash)
+
+        rows = []
+        keys = list(sweep.keys())
+        for point, _ in points:
+            row = {k: point[k] for k in keys}
+            if point["hash"] in failed:
+                row["status"] = "failed"
+            else:
+                result_path = cache_dir / point["hash"] / "result.json"
+                row.update(json.loads(result_path.read_text()))
+                if point["hash"] in reused:
+                    row["status"] = "cached"
+                else:
+                    row["status"] = point["status"]
+            row["hash"] = point["hash"]
+            rows.append(row)
+
+        print_sweep_table(keys, rows)
+        results_path = cache_dir / f"sweep_{litex_name}.json"
+        results_path.write_text(json.dumps(rows, indent=2, default=str))
+        print(f"[{litex_name}] Sweep results: "
+              f"{results_path.resolve().as_posix()}")
+
+        if failed:
+            print(f"ERROR: {len(failed)} sweep points failed to generate")
+            sys.exit(1)
+
     def run(self):
         config_file = self.config.get("config_file", None)
         if not config_file:
@@ -325,56 +694,28 @@ class LiteDramGen(Generator):
             sys.exit(1)
 
         sim = self.config.get("sim", False)
+        sweep = self.config.get("sweep", None)
 
         in_config_path = Path(self.files_root) / config_file
         in_config = yaml.safe_load(in_config_path.read_text())
 
         litex_name = in_config.get("name", "litedram_core")
-        litedram_config = translate_config(in_config)
-
-        output_dir = Path("litex_build")
-        verilog_path = output_dir / "gateware" / f"{litex_name}.v"
-        xdc_path = output_dir / "gateware" / f"{litex_name}.xdc"
+        if sweep is not None:
+            self.run_sweep(in_config, litex_name, sweep, sim)
+            return
 
-        out_config_path = Path("litedram_config.yml")
-        out_config_path.write_text(yaml.dump(litedram_config))
-
-        command = [
-            "litedram_gen",
-            "--no-compile",
-            "--name", litex_name,
-            "--output-dir", output_dir.resolve().as_posix(),
-            out_config_path.resolve().as_posix()
-        ]
+        litedram_config = translate_config(in_config)
+        custom_module = custom_module_def(in_config)
 
-        if sim:
-            command.append("--sim")
+        core_dir = self.cache_dir() / config_hash(
+            litex_name, litedram_config, custom_module, sim)
+        _, generated = generate_core(
+            litex_name, litedram_config, custom_module, core_dir, sim)
+        if not generated:
+            print(f"[{litex_name}] Config unchanged. Reusing generated core.")
 
-        log_file = output_dir / "litedram_gen.log"
-        output_dir.mkdir(parents=True, exist_ok=True)
-        with open(log_file, "w") as f:
-            try:
-                subprocess.check_call(command, stdout=f, stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError:
-                print("ERROR: litedram_gen failed")
-                print(f"See log: {log_file.resolve().as_posix()}")
-                sys.exit(1)
-            except FileNotFoundError:
-                print("ERROR: litedram_gen command not found. "
-                        "Is litex installed and on PATH?")
-                sys.exit(1)
-
-        if not verilog_path.is_file():
-            print("ERROR: litedram_gen failed, output verilog not found:")
-            print(f"       {verilog_path.resolve().as_posix()}")
-            print(f"See log: {log_file.resolve().as_posix()}")
-            sys.exit(1)
-
-        if not sim and not xdc_path.is_file():
-            print("ERROR: litedram_gen failed, output constraints not found:")
-            print(f"       {xdc_path.resolve().as_posix()}")
-            print(f"See log: {log_file.resolve().as_posix()}")
-            sys.exit(1)
+        output_dir = core_dir / "litex_build"
+        verilog_path, xdc_path = core_output_paths(output_dir, litex_name)
 
         self.add_files(
             [verilog_path.resolve().as_posix()],
@@ -390,9 +731,14 @@ class LiteDramGen(Generator):
             )
 
         print(f"[{litex_name}] LiteDRAM generation completed")
+        print(f"[{litex_name}] Build directory: "
+              f"{output_dir.resolve().as_posix()}")
 
 
 if __name__ == "__main__":
-    generator = LiteDramGen()
-    generator.run()
-    generator.write()
+    if sys.argv[1:2] == [LITEDRAM_GEN_ARG]:
+        litedram_gen_main(sys.argv[2:])
+    else:
+        generator = LiteDramGen()
+        generator.run()
+        generator.write()
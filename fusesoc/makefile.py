@@ -35,6 +35,9 @@ from pathlib import Path
 
 from fusesoc.capi2.generator import Generator
 
+from jobserver import get_jobserver
+from outputs import output_lock
+
 
 class Makefile(Generator):
     def run(self):
@@ -46,14 +49,23 @@ class Makefile(Generator):
         if target:
             command.append(target)
 
-        try:
-            subprocess.check_call(command, cwd=working_dir)
-        except subprocess.CalledProcessError:
-            print("ERROR: Makefile failed")
-            sys.exit(1)
-        except FileNotFoundError:
-            print("ERROR: 'make' command not found. Is make installed?")
-            sys.exit(1)
+        # make takes its job tokens from the build's jobserver, if any
+        jobserver = get_jobserver()
+
+        # two makes in the same directory race on every target they share;
+        # the lock (.make.lock) lives inside the directory it protects
+        with output_lock(working_dir / "make"):
+            try:
+                with jobserver.slots():
+                    subprocess.check_call(
+                        command, cwd=working_dir,
+                        **jobserver.subprocess_args())
+            except subprocess.CalledProcessError:
+                print("ERROR: Makefile failed")
+                sys.exit(1)
+            except FileNotFoundError:
+                print("ERROR: 'make' command not found. Is make installed?")
+                sys.exit(1)
 
 
 if __name__ == "__main__":
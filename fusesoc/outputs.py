@@ -0,0 +1,114 @@
+#                           /$$
+#                          |__/
+#        /$$$$$$$  /$$$$$$  /$$ /$$$$$$$  /$$   /$$
+#       /$$_____/ /$$__  $$| $$| $$__  $$| $$  | $$
+#      |  $$$$$$ | $$  \ $$| $$| $$  \ $$| $$  | $$   (c) Craig J Bishop
+#       \____  $$| $$  | $$| $$| $$  | $$| $$  | $$   All rights reserved
+#       /$$$$$$$/| $$$$$$$/| $$| $$  | $$|  $$$$$$$
+#      |_______/ | $$____/ |__/|__/  |__/ \____  $$   MIT License
+#                | $$                     /$$  | $$
+#                | $$                    |  $$$$$$/
+#                |__/                     \______/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+# NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+# USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Concurrency-safe generator outputs
+
+Generators stage their work in a private temporary directory, then publish
+it with atomic renames while holding a per-output file lock. A build that
+waited on the lock can check whether another process just produced the
+output it needs, and reuse it instead of regenerating.
+"""
+
+import os
+import fcntl
+import shutil
+import tempfile
+from pathlib import Path
+from contextlib import contextmanager
+
+
+def lock_path_for(output_path):
+    return output_path.parent / f".{output_path.name}.lock"
+
+
+@contextmanager
+def output_lock(output_path):
+    """Exclusive lock on an output, shared between concurrent builds"""
+    lock_path = lock_path_for(output_path)
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print(f"Waiting for another build to finish: {output_path}")
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextmanager
+def staging_dir(output_path):
+    """
+    Private temporary directory next to the output, so it is on the same
+    filesystem and can be published with a rename
+    """
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    path = Path(tempfile.mkdtemp(
+        prefix=f".{output_path.name}.tmp-", dir=output_path.parent))
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def publish_dir(staged_path, output_path):
+    """
+    Replace the output directory with a staged one (hold output_lock).
+    The old output is moved aside first, since a rename can't replace a
+    non-empty directory.
+    """
+    old_path = None
+    if output_path.exists():
+        old_path = output_path.with_name(
+            f".{output_path.name}.old-{os.getpid()}")
+        os.rename(output_path, old_path)
+    os.rename(staged_path, output_path)
+    if old_path is not None:
+        shutil.rmtree(old_path, ignore_errors=True)
+
+
+def publish_file(src_path, output_path):
+    """Atomically copy a file to the output path"""
+    tmp_path = output_path.with_name(
+        f".{output_path.name}.tmp-{os.getpid()}")
+    shutil.copy2(src_path, tmp_path)
+    os.replace(tmp_path, output_path)
+
+
+def write_text_atomic(output_path, text):
+    tmp_path = output_path.with_name(
+        f".{output_path.name}.tmp-{os.getpid()}")
+    tmp_path.write_text(text)
+    os.replace(tmp_path, output_path)
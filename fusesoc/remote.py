@@ -0,0 +1,577 @@
+#                           /$$
+#                          |__/
+#        /$$$$$$$  /$$$$$$  /$$ /$$$$$$$  /$$   /$$
+#       /$$_____/ /$$__  $$| $$| $$__  $$| $$  | $$
+#      |  $$$$$$ | $$  \ $$| $$| $$  \ $$| $$  | $$   (c) Craig J Bishop
+#       \____  $$| $$  | $$| $$| $$  | $$| $$  | $$   All rights reserved
+#       /$$$$$$$/| $$$$$$$/| $$| $$  | $$|  $$$$$$$
+#      |_______/ | $$____/ |__/|__/  |__/ \____  $$   MIT License
+#                | $$                     /$$  | $$
+#                | $$                    |  $$$$$$/
+#                |__/                     \______/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+# NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+# USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+"""
+Remote execution of expensive generator steps on a pool of workers
+
+A generator step (e.g. generating a LiteDRAM core, or PAC sources) is
+identified by its name, its JSON arguments, and the content hashes of its
+input files. When SPINY_WORKERS lists workers (`host:port,host:port`), the
+coordinator (the generator) sends the step to one of them:
+
+    coordinator                         worker
+    {"op": "run", step, args, inputs} ->
+                                     <- {"missing": [hashes]}
+    one blob per missing hash         ->
+                                     <- {"status": "ok", ...} + outputs blob
+
+Messages are length-prefixed JSON, and blobs are length-prefixed bytes.
+Workers keep input blobs and step outputs in a content-addressed cache, so
+unchanged inputs are only sent once, and repeated steps are not re-run.
+Cached outputs are keyed on the worker's generator code and tool versions
+too, so upgrading either re-runs the step.
+Each step runs in a child process inside a private sandbox directory,
+using the same generator code as a local run.
+
+If a worker can't be reached, or doesn't reply within SPINY_REMOTE_TIMEOUT
+seconds (default one hour), the step is retried on the next one. If no
+worker can run it, the step runs locally instead. Workers have no
+authentication, so only run them on a trusted network.
+
+Start a worker on each machine in the pool:
+
+    python3 fusesoc/remote.py worker --host 0.0.0.0 --port 7878
+
+Or, to test on one machine, run a build against a pool of localhost workers:
+
+    python3 fusesoc/remote.py pool -n 2 -- fusesoc run --build ...
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import struct
+import hashlib
+import tarfile
+import tempfile
+import threading
+import importlib
+import importlib.metadata
+import subprocess
+import socketserver
+from pathlib import Path
+
+
+WORKERS_ENV = "SPINY_WORKERS"
+TIMEOUT_ENV = "SPINY_REMOTE_TIMEOUT"
+PROTOCOL_VERSION = 1
+DEFAULT_PORT = 7878
+CONNECT_TIMEOUT = 5.0
+# longest wait for any reply from a worker, including a step's result
+DEFAULT_STEP_TIMEOUT = 3600.0
+ATTEMPTS = 2
+CHUNK_SIZE = 1 << 20
+
+# steps a worker can run, and the generator module that implements each as
+# run_remote_step(inputs, output_dir, args)
+STEP_MODULES = {
+    "litedram": "litedram_gen",
+    "rustpac": "rustpac",
+}
+
+# tools each step's outputs depend on, besides the generator code: Python
+# packages, and commands that accept --version
+STEP_PACKAGES = {
+    "litedram": ["litex", "litedram", "migen"],
+}
+STEP_COMMANDS = {
+    "rustpac": ["svd2rust", "form", "rustfmt"],
+}
+
+# exit code of a step runner that can't import its generator module, so the
+# coordinator tries elsewhere rather than reporting a step failure
+EXIT_UNAVAILABLE = 3
+
+MESSAGE_HEADER = struct.Struct(">I")
+BLOB_HEADER = struct.Struct(">Q")
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class StepUnavailable(ProtocolError):
+    pass
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def step_key(step, args, input_hashes):
+    key = {
+        "version": PROTOCOL_VERSION,
+        "step": step,
+        "args": args,
+        "inputs": input_hashes,
+    }
+    encoded = json.dumps(key, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def recv_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ProtocolError("connection closed")
+    return data
+
+
+def send_message(sock, message):
+    data = json.dumps(message).encode()
+    sock.sendall(MESSAGE_HEADER.pack(len(data)) + data)
+
+
+def recv_message(stream):
+    (size,) = MESSAGE_HEADER.unpack(recv_exactly(stream, MESSAGE_HEADER.size))
+    try:
+        message = json.loads(recv_exactly(stream, size))
+    except ValueError:
+        raise ProtocolError("invalid message")
+    if not isinstance(message, dict):
+        raise ProtocolError("invalid message")
+    return message
+
+
+def send_blob(sock, path):
+    with open(path, "rb") as f:
+        sock.sendall(BLOB_HEADER.pack(os.fstat(f.fileno()).st_size))
+        sock.sendfile(f)
+
+
+def recv_blob(stream, path, expected_hash=None):
+    """Receive a blob into path, via a temporary file so it appears whole"""
+    (size,) = BLOB_HEADER.unpack(recv_exactly(stream, BLOB_HEADER.size))
+    h = hashlib.sha256()
+    tmp_path = path.with_name(f".{path.name}.tmp-{threading.get_ident()}")
+    try:
+        with open(tmp_path, "wb") as f:
+            while size > 0:
+                chunk = recv_exactly(stream, min(size, CHUNK_SIZE))
+                h.update(chunk)
+                f.write(chunk)
+                size -= len(chunk)
+        if expected_hash is not None and h.hexdigest() != expected_hash:
+            raise ProtocolError(f"blob hash mismatch for {expected_hash}")
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def pack_dir(src_path, archive_path):
+    with tarfile.open(archive_path, "w:gz") as tar:
+        tar.add(src_path, arcname=".")
+
+
+def unpack_dir(archive_path, dest_path):
+    with tarfile.open(archive_path, "r:gz") as tar:
+        if hasattr(tarfile, "data_filter"):
+            tar.extractall(dest_path, filter="data")
+        else:
+            tar.extractall(dest_path)
+
+
+def clear_dir(path):
+    shutil.rmtree(path, ignore_errors=True)
+    path.mkdir(parents=True)
+
+
+def get_step_timeout():
+    timeout = os.environ.get(TIMEOUT_ENV)
+    return float(timeout) if timeout else DEFAULT_STEP_TIMEOUT
+
+
+def get_workers():
+    workers = []
+    for entry in os.environ.get(WORKERS_ENV, "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, port = entry.rpartition(":")
+        if not host:
+            host, port = port, DEFAULT_PORT
+        workers.append((host, int(port)))
+    return workers
+
+
+def run_local(step, args, inputs, output_dir):
+    module = importlib.import_module(STEP_MODULES[step])
+    module.run_remote_step(inputs, output_dir, args)
+
+
+def run_on_worker(address, step, args, inputs, input_hashes, output_dir):
+    """
+    Run a step on one worker, unpacking its outputs into output_dir.
+    Returns False if the step itself failed on the worker.
+    """
+    host, port = address
+    with socket.create_connection(address, timeout=CONNECT_TIMEOUT) as sock:
+        # steps can take minutes, so replies get a much longer timeout than
+        # connecting, after which a stalled worker is treated as failed
+        sock.settimeout(get_step_timeout())
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        stream = sock.makefile("rb")
+
+        send_message(sock, {
+            "op": "run",
+            "version": PROTOCOL_VERSION,
+            "step": step,
+            "args": args,
+            "inputs": input_hashes,
+        })
+        reply = recv_message(stream)
+        if "error" in reply:
+            raise ProtocolError(reply["error"])
+        if not isinstance(reply.get("missing"), list):
+            raise ProtocolError("invalid reply")
+        paths_by_hash = {input_hashes[n]: p for n, p in inputs.items()}
+        for blob_hash in reply["missing"]:
+            if (not isinstance(blob_hash, str)
+                    or blob_hash not in paths_by_hash):
+                raise ProtocolError(f"unknown input requested: {blob_hash}")
+            send_blob(sock, paths_by_hash[blob_hash])
+
+        reply = recv_message(stream)
+        status = reply.get("status")
+        if status not in ("ok", "failed", "unavailable"):
+            raise ProtocolError("invalid reply")
+        if status == "unavailable":
+            raise StepUnavailable(reply.get("log", "").strip())
+        if status == "failed":
+            print(f"[remote] {step} failed on {host}:{port}:")
+            for line in reply.get("log", "").strip().splitlines()[-20:]:
+                print(f"  {line}")
+            return False
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive_path = Path(tmp_dir) / "outputs.tar.gz"
+            recv_blob(stream, archive_path)
+            unpack_dir(archive_path, output_dir)
+
+    cached = " (cached)" if reply.get("cached") else ""
+    print(f"[remote] {step} ran on {host}:{port}{cached}")
+    return True
+
+
+def run_step(step, args, inputs, output_dir):
+    """
+    Run a generator step, writing its outputs into output_dir (an empty,
+    private directory). Uses the workers in SPINY_WORKERS if any are set,
+    retrying on the others if one fails, and falls back to running locally.
+
+    inputs maps input names (plain file names) to local paths.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    workers = get_workers()
+    if not workers:
+        run_local(step, args, inputs, output_dir)
+        return
+
+    input_hashes = {name: file_hash(path) for name, path in inputs.items()}
+
+    # spread steps across workers, but send the same step to the same
+    # worker first, where its result is likely cached
+    start = int(step_key(step, args, input_hashes), 16) % len(workers)
+    order = workers[start:] + workers[:start]
+
+    unavailable = set()
+    for attempt in range(ATTEMPTS):
+        for address in order:
+            if address in unavailable:
+                continue
+            try:
+                if run_on_worker(address, step, args, inputs, input_hashes,
+                                 output_dir):
+                    return
+                # the step itself failed; the local run reports the error,
+                # or succeeds if the worker's environment was the problem
+                clear_dir(output_dir)
+                print(f"[remote] Running {step} locally")
+                run_local(step, args, inputs, output_dir)
+                return
+            except (OSError, ProtocolError, tarfile.TarError) as e:
+                if isinstance(e, StepUnavailable):
+                    unavailable.add(address)
+                host, port = address
+                print(f"[remote] {step} on {host}:{port} "
+                      f"(attempt {attempt + 1}): {e}")
+                clear_dir(output_dir)
+
+    print(f"[remote] No worker could run {step}, running locally")
+    run_local(step, args, inputs, output_dir)
+
+
+def run_step_in_sandbox(sandbox_path):
+    """Step runner, in a child process of the worker"""
+    spec = json.loads((sandbox_path / "step.json").read_text())
+    try:
+        module = importlib.import_module(STEP_MODULES[spec["step"]])
+    except ImportError as e:
+        print(f"Step {spec['step']} unavailable on this worker: {e}")
+        sys.exit(EXIT_UNAVAILABLE)
+
+    inputs = {
+        name: sandbox_path / "inputs" / name for name in spec["inputs"]}
+    module.run_remote_step(inputs, sandbox_path / "outputs", spec["args"])
+
+
+class Worker:
+    def __init__(self, cache_dir, jobs):
+        self.cache_dir = Path(cache_dir)
+        self.blobs_dir = self.cache_dir / "blobs"
+        self.results_dir = self.cache_dir / "results"
+        self.sandbox_dir = self.cache_dir / "sandbox"
+        for path in (self.blobs_dir, self.results_dir, self.sandbox_dir):
+            path.mkdir(parents=True, exist_ok=True)
+        self.slots = threading.BoundedSemaphore(jobs)
+
+    def environment_hash(self, step):
+        """
+        Hash of everything besides the request that a step's outputs depend
+        on: the generator modules (and helpers) the step runner imports, and
+        the tool versions. Checked per request, so upgrades take effect
+        without restarting the worker.
+        """
+        h = hashlib.sha256(sys.version.encode())
+        for module_path in sorted(Path(__file__).parent.glob("*.py")):
+            h.update(f"{module_path.name} {file_hash(module_path)}\n".encode())
+        for package in STEP_PACKAGES.get(step, []):
+            try:
+                version = importlib.metadata.version(package)
+            except importlib.metadata.PackageNotFoundError:
+                version = None
+            h.update(f"{package} {version}\n".encode())
+        for command in STEP_COMMANDS.get(step, []):
+            try:
+                version = subprocess.run(
+                    [command, "--version"], capture_output=True, text=True
+                ).stdout.strip()
+            except FileNotFoundError:
+                version = None
+            h.update(f"{command} {version}\n".encode())
+        return h.hexdigest()
+
+    def validate_request(self, request):
+        """Returns an error for a malformed request, or None"""
+        if request.get("op") != "run":
+            return f"unknown op: {request.get('op')}"
+        if request.get("version") != PROTOCOL_VERSION:
+            return "protocol version mismatch"
+        step = request.get("step")
+        if not isinstance(step, str) or step not in STEP_MODULES:
+            return f"unknown step: {step}"
+        if not isinstance(request.get("args"), dict):
+            return "args must be a map"
+        input_hashes = request.get("inputs")
+        if not isinstance(input_hashes, dict):
+            return "inputs must be a map"
+        for name, blob_hash in input_hashes.items():
+            if Path(name).name != name or name in (".", ".."):
+                return f"invalid input name: {name}"
+            if (not isinstance(blob_hash, str) or len(blob_hash) != 64
+                    or not all(c in "0123456789abcdef" for c in blob_hash)):
+                return f"invalid hash: {blob_hash}"
+        return None
+
+    def handle(self, sock):
+        stream = sock.makefile("rb")
+        request = recv_message(stream)
+
+        error = self.validate_request(request)
+        if error is not None:
+            send_message(sock, {"error": error})
+            return
+        step = request["step"]
+        input_hashes = request["inputs"]
+
+        missing = sorted({
+            h for h in input_hashes.values()
+            if not (self.blobs_dir / h).is_file()})
+        send_message(sock, {"missing": missing})
+        for blob_hash in missing:
+            recv_blob(stream, self.blobs_dir / blob_hash, blob_hash)
+
+        key = step_key(step, request["args"], input_hashes)
+        environment = self.environment_hash(step)
+        result_path = self.results_dir / f"{key}-{environment}.tar.gz"
+        if result_path.is_file():
+            send_message(sock, {"status": "ok", "cached": True})
+            send_blob(sock, result_path)
+            return
+
+        with self.slots:
+            status, log = self.run_step(request, result_path)
+        send_message(sock, {"status": status, "cached": False, "log": log})
+        if status == "ok":
+            send_blob(sock, result_path)
+
+    def run_step(self, request, result_path):
+        sandbox_path = Path(tempfile.mkdtemp(dir=self.sandbox_dir))
+        try:
+            inputs_path = sandbox_path / "inputs"
+            outputs_path = sandbox_path / "outputs"
+            inputs_path.mkdir()
+            outputs_path.mkdir()
+            for name, blob_hash in request["inputs"].items():
+                shutil.copyfile(self.blobs_dir / blob_hash, inputs_path / name)
+            (sandbox_path / "step.json").write_text(json.dumps(request))
+
+            start = time.monotonic()
+            result = subprocess.run(
+                [sys.executable, Path(__file__).resolve().as_posix(),
+                 "run-step", sandbox_path.as_posix()],
+                cwd=sandbox_path,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True
+            )
+            seconds = time.monotonic() - start
+            print(f"[worker] {request['step']} finished in {seconds:.1f}s "
+                  f"(exit code {result.returncode})")
+
+            if result.returncode == EXIT_UNAVAILABLE:
+                return "unavailable", result.stdout
+            if result.returncode != 0:
+                return "failed", result.stdout
+
+            tmp_path = result_path.with_name(
+                f".{result_path.name}.tmp-{threading.get_ident()}")
+            pack_dir(outputs_path, tmp_path)
+            os.replace(tmp_path, result_path)
+            return "ok", result.stdout
+        finally:
+            shutil.rmtree(sandbox_path, ignore_errors=True)
+
+
+class WorkerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, worker):
+        self.worker = worker
+        super().__init__(address, WorkerHandler)
+
+
+class WorkerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            self.server.worker.handle(self.request)
+        except (OSError, ProtocolError) as e:
+            print(f"[worker] Connection from {self.client_address[0]}: {e}")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Remote execution workers for Spiny generator steps")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    worker_parser = subparsers.add_parser("worker", help="Run a worker")
+    worker_parser.add_argument("--host", default="127.0.0.1",
+        help="Address to listen on (default: 127.0.0.1)")
+    worker_parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+        help=f"Port to listen on (default: {DEFAULT_PORT})")
+    worker_parser.add_argument("-j", "--jobs", type=int,
+        default=os.cpu_count() or 1,
+        help="Steps to run at once (default: CPU count)")
+    worker_parser.add_argument("--cache-dir",
+        default=Path.home() / ".cache" / "spiny-worker",
+        help="Blob and result cache (default: ~/.cache/spiny-worker)")
+
+    pool_parser = subparsers.add_parser("pool",
+        help="Run a command against a pool of localhost workers")
+    pool_parser.add_argument("-n", "--workers", type=int, default=2,
+        help="Number of workers (default: 2)")
+    pool_parser.add_argument("command", nargs=argparse.REMAINDER,
+        help="Command to run (after --)")
+
+    run_step_parser = subparsers.add_parser("run-step")
+    run_step_parser.add_argument("sandbox")
+
+    args = parser.parse_args()
+
+    if args.mode == "run-step":
+        run_step_in_sandbox(Path(args.sandbox))
+        return
+
+    if args.mode == "worker":
+        server = WorkerServer(
+            (args.host, args.port), Worker(args.cache_dir, args.jobs))
+        print(f"[worker] Listening on {args.host}:{args.port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    command = args.command
+    if command and command[0] == "--":
+        command = command[1:]
+    if not command:
+        print("ERROR: No command given")
+        sys.exit(1)
+
+    tmp_dir = tempfile.mkdtemp(prefix="spiny-workers-")
+    servers = []
+    try:
+        for i in range(args.workers):
+            worker = Worker(Path(tmp_dir) / f"worker{i}", jobs=1)
+            server = WorkerServer(("127.0.0.1", 0), worker)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            servers.append(server)
+
+        env = dict(os.environ)
+        env[WORKERS_ENV] = ",".join(
+            f"127.0.0.1:{s.server_address[1]}" for s in servers)
+        print(f"[pool] Workers: {env[WORKERS_ENV]}")
+        try:
+            returncode = subprocess.call(command, env=env)
+        except FileNotFoundError:
+            print(f"ERROR: '{command[0]}' command not found")
+            returncode = 1
+    finally:
+        for server in servers:
+            server.shutdown()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    sys.exit(returncode)
+
+
+if __name__ == "__main__":
+    main()
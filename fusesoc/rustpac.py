@@ -29,16 +29,23 @@
 # OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
 # USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import os
 import sys
+import re
 import subprocess
 import shutil
 import textwrap
 import hashlib
 import json
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from fusesoc.capi2.generator import Generator
 
+from jobserver import get_jobserver
+from outputs import output_lock, staging_dir, publish_dir, write_text_atomic
+from remote import run_step
+
 
 BUILD_RS_CONTENT = textwrap.dedent("""\
     use std::env;
@@ -71,6 +78,127 @@ BUILD_RS_CONTENT = textwrap.dedent("""\
     }
 """)
 
+# svd2rust --feature-peripheral gates each peripheral with its own feature
+PERIPHERAL_FEATURE_RE = re.compile(r'#\[cfg\(feature = "([^"]+)"\)\]')
+
+# features that svd2rust gates on, but which are not peripherals
+NON_PERIPHERAL_FEATURES = ["rt", "critical-section"]
+
+
+def run_svd2rust(work_path, svd_src_path, peripheral_features):
+    if not svd_src_path.is_file():
+        print("ERROR: SVD input does not exist or is not a file")
+        print(f"(expected here: {svd_src_path.resolve().as_posix()}")
+        sys.exit(1)
+
+    command = [
+        "svd2rust",
+        "-i", svd_src_path.resolve().as_posix(),
+        "--target", "riscv"
+    ]
+    if peripheral_features:
+        command.append("--feature-peripheral")
+
+    try:
+        subprocess.check_call(command, cwd=work_path)
+    except subprocess.CalledProcessError:
+        print("ERROR: svd2rust failed")
+        sys.exit(1)
+    except FileNotFoundError:
+        print("ERROR: 'svd2rust' command not found. " + 
+            "Is svd2rust installed?")
+        sys.exit(1)
+
+    lib_rs_path = work_path / "lib.rs"
+    if not lib_rs_path.is_file():
+        print("ERROR: svd2rust failed to generate lib.rs")
+        print(f"(expected here: {lib_rs_path.resolve().as_posix()})")
+        sys.exit(1)
+
+    device_x_path = work_path / "device.x"
+    if not device_x_path.is_file():
+        print("ERROR: svd2rust failed to generate device.x")
+        print(f"(expected here: {device_x_path.resolve().as_posix()})")
+        sys.exit(1)
+
+    return lib_rs_path, device_x_path
+
+def run_form(work_path, lib_rs_path):
+    src_path = work_path / "src"
+    if src_path.exists():
+        shutil.rmtree(src_path)
+    src_path.mkdir(parents=True)
+
+    try:
+        subprocess.check_call([
+            "form",
+            "-i", lib_rs_path.resolve().as_posix(),
+            "-o", src_path.resolve().as_posix()
+        ])
+    except subprocess.CalledProcessError:
+        print("ERROR: form failed")
+        print("(make sure it's installed and on PATH)")
+        sys.exit(1)
+    except FileNotFoundError:
+        print("ERROR: 'form' command not found. Is form installed?")
+        sys.exit(1)
+
+    if not any(src_path.iterdir()):
+        print("ERROR: src directory output from form is empty")
+        sys.exit(1)
+
+    return src_path
+
+def rustfmt_file(jobserver, rs_path):
+    # formatting through stdin keeps rustfmt from following `mod`
+    # declarations, so each file is only formatted once
+    with jobserver.slots():
+        result = subprocess.run(
+            ["rustfmt", "--edition", "2021", "--emit", "stdout"],
+            input=rs_path.read_bytes(),
+            capture_output=True
+        )
+    if result.returncode != 0:
+        return result.stderr.decode(errors="replace")
+    rs_path.write_bytes(result.stdout)
+    return None
+
+def run_rustfmt(src_path):
+    src_lib_rs_path = src_path / "lib.rs"
+    if not src_lib_rs_path.is_file():
+        print("ERROR: src/lib.rs is missing for rustfmt")
+        sys.exit(1)
+
+    if shutil.which("rustfmt") is None:
+        print("ERROR: 'rustfmt' command not found. Is rustfmt installed?")
+        sys.exit(1)
+
+    # one worker per job slot from the build's jobserver
+    jobserver = get_jobserver()
+    rs_paths = sorted(src_path.rglob("*.rs"))
+    workers = getattr(jobserver, "jobs", None) or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        errors = list(executor.map(
+            lambda p: rustfmt_file(jobserver, p), rs_paths))
+
+    failed = [(p, e) for p, e in zip(rs_paths, errors) if e is not None]
+    if failed:
+        print("ERROR: rustfmt failed")
+        for rs_path, error in failed:
+            print(f"({rs_path.as_posix()}) {error}")
+        sys.exit(1)
+
+
+def run_remote_step(inputs, output_dir, args):
+    """
+    Generate formatted PAC sources (src/ and device.x) into output_dir, as a
+    step that can run on a remote worker (see remote.py)
+    """
+    lib_rs_path, _ = run_svd2rust(
+        output_dir, inputs["device.svd"], args["peripheral_features"])
+    src_path = run_form(output_dir, lib_rs_path)
+    run_rustfmt(src_path)
+
 
 class RustPacGen(Generator):
     def get_file_hash(self, path):
@@ -82,85 +210,45 @@ class RustPacGen(Generator):
                 h.update(chunk)
         return h.hexdigest()
 
-    def run_svd2rust(self, files_root, svd_src_path):
-        if not svd_src_path.is_file():
-            print("ERROR: SVD input does not exist or is not a file")
-            print(f"(expected here: {svd_src_path.resolve().as_posix()}")
-            sys.exit(1)
-
-        try:
-            subprocess.check_call([
-                "svd2rust",
-                "-i", svd_src_path.resolve().as_posix(),
-                "--target", "riscv"
-            ])
-        except subprocess.CalledProcessError:
-            print("ERROR: svd2rust failed")
-            sys.exit(1)
-        except FileNotFoundError:
-            print("ERROR: 'svd2rust' command not found. " + 
-                "Is svd2rust installed?")
-            sys.exit(1)
-
-        lib_rs_path = Path("lib.rs")
-        if not lib_rs_path.is_file():
-            print("ERROR: svd2rust failed to generate lib.rs")
-            print(f"(expected here: {lib_rs_path.resolve().as_posix()})")
-            sys.exit(1)
-
-        device_x_path = Path("device.x")
-        if not device_x_path.is_file():
-            print("ERROR: svd2rust failed to generate device.x")
-            print(f"(expected here: {device_x_path.resolve().as_posix()})")
-            sys.exit(1)
-
-        return lib_rs_path, device_x_path
-
-    def run_form(self, lib_rs_path):
-        src_path = Path("src")
-        if src_path.exists():
-            shutil.rmtree(src_path)
-        src_path.mkdir(parents=True)
-
-        try:
-            subprocess.check_call([
-                "form",
-                "-i", lib_rs_path.resolve().as_posix(),
-                "-o", src_path.resolve().as_posix()
-            ])
-        except subprocess.CalledProcessError:
-            print("ERROR: form failed")
-            print("(make sure it's installed and on PATH)")
-            sys.exit(1)
-        except FileNotFoundError:
-            print("ERROR: 'form' command not found. Is form installed?")
+    def find_peripheral_features(self, src_path):
+        """
+        Collect the per-peripheral features svd2rust gated the generated
+        modules behind, in order of first appearance
+        """
+        features = []
+        for rs_path in sorted(src_path.rglob("*.rs")):
+            for feature in PERIPHERAL_FEATURE_RE.findall(rs_path.read_text()):
+                if (feature not in NON_PERIPHERAL_FEATURES and
+                        feature not in features):
+                    features.append(feature)
+        return features
+
+    def find_used_peripherals(self, firmware_src_path, features):
+        """
+        Scan firmware sources for references to each peripheral, either by
+        field/module name (e.g. `timer`) or by type name (e.g. `Timer`)
+        """
+        if not firmware_src_path.is_dir():
+            print("ERROR: Firmware source directory does not exist")
+            print(f"(expected here: {firmware_src_path.resolve().as_posix()})")
             sys.exit(1)
 
-        if not any(src_path.iterdir()):
-            print("ERROR: src directory output from form is empty")
-            sys.exit(1)
-
-        return src_path
-
-    def run_rustfmt(self, src_path):
-        src_lib_rs_path = src_path / "lib.rs"
-        if not src_lib_rs_path.is_file():
-            print("ERROR: src/lib.rs is missing for rustfmt")
-            sys.exit(1)
-
-        try:
-            subprocess.check_call(
-                ["rustfmt", src_lib_rs_path.resolve().as_posix()]
-            )
-        except subprocess.CalledProcessError:
-            print("ERROR: rustfmt failed")
-            print("(make sure it's installed and on PATH)")
-            sys.exit(1)
-        except FileNotFoundError:
-            print("ERROR: 'rustfmt' command not found. Is rustfmt installed?")
-            sys.exit(1)
-
-    def generate_cargo_toml(self, crate_name, crate_version):
+        firmware_src = "\n".join(
+            rs_path.read_text()
+            for rs_path in sorted(firmware_src_path.rglob("*.rs"))
+        )
+
+        used = []
+        for feature in features:
+            type_name = "".join(
+                part.capitalize() for part in feature.split("_"))
+            pattern = rf"\b({re.escape(feature)}|{re.escape(type_name)})\b"
+            if re.search(pattern, firmware_src):
+                used.append(feature)
+        return used
+
+    def generate_cargo_toml(self, crate_name, crate_version,
+                            peripheral_features=None, default_features=None):
         content = textwrap.dedent(f"""\
             [package]
             name = "{crate_name}"
@@ -172,8 +260,13 @@ class RustPacGen(Generator):
             vcell = "0.1.3"
 
             [features]
-            rt = []
         """)
+        if peripheral_features:
+            default_list = ", ".join(f'"{f}"' for f in default_features)
+            content += f"default = [{default_list}]\n"
+        content += "rt = []\n"
+        for feature in peripheral_features or []:
+            content += f"{feature} = []\n"
         return content
 
     def run(self):
@@ -182,6 +275,8 @@ class RustPacGen(Generator):
         output_path = self.config.get("output_path")
         svd_path = self.config.get("svd_path")
         linker_script_path = self.config.get("linker_script_path")
+        peripheral_features = self.config.get("peripheral_features", False)
+        firmware_src_dir = self.config.get("firmware_src_dir")
 
         missing_parameter = False
         if not crate_name:
@@ -196,6 +291,10 @@ class RustPacGen(Generator):
         if not svd_path:
             print("ERROR: 'svd_path' is a required parameter")
             missing_parameter = True
+        if firmware_src_dir and not peripheral_features:
+            print("ERROR: 'peripheral_features' must be enabled "
+                  "if 'firmware_src_dir' is set")
+            missing_parameter = True
         if missing_parameter:
             sys.exit(1)
 
@@ -211,9 +310,22 @@ class RustPacGen(Generator):
             "svd": self.get_file_hash(svd_src_path),
             "linker_script": self.get_file_hash(linker_script_src),
             "crate_name": crate_name,
-            "crate_version": crate_version
+            "crate_version": crate_version,
+            "peripheral_features": bool(peripheral_features)
         }
 
+        # concurrent builds wait here, then reuse the output if another
+        # build just generated it from the same inputs
+        with output_lock(output_path):
+            self.update_crate(
+                output_path, current_hashes, svd_src_path, linker_script_src,
+                files_root, firmware_src_dir)
+
+    def update_crate(self, output_path, current_hashes, svd_src_path,
+                     linker_script_src, files_root, firmware_src_dir):
+        crate_name = current_hashes["crate_name"]
+        peripheral_features = current_hashes["peripheral_features"]
+
         should_run = True
         state_file = output_path / ".generator_state.json"
         if output_path.exists() and not state_file.exists():
@@ -230,31 +342,75 @@ class RustPacGen(Generator):
                 saved_state = json.loads(state_file.read_text())
                 if saved_state == current_hashes:
                     print(f"[{crate_name}] Inputs unchanged. Skipping generation.")
-                    return
+                    should_run = False
             except (json.JSONDecodeError, KeyError):
                 pass
 
-        # generate PAC src files and format
-        lib_rs_path, device_x_path = self.run_svd2rust(
-            files_root, svd_src_path)
-        src_path = self.run_form(lib_rs_path)
-        self.run_rustfmt(src_path)
-
-        # copy src and device.x to output crate
-        dest_src_path = output_path / "src"
-        if dest_src_path.exists():
-            shutil.rmtree(dest_src_path)
-        shutil.copytree(src_path, dest_src_path)
-        shutil.copy2(device_x_path, output_path / "device.x")
-
-        # optional linker script
-        if linker_script_src:
-            shutil.copy2(linker_script_src, output_path / "pac.x")
-
-        (output_path / "Cargo.toml").write_text(
-            self.generate_cargo_toml(crate_name, crate_version))
-        (output_path / "build.rs").write_text(BUILD_RS_CONTENT)
-        state_file.write_text(json.dumps(current_hashes))
+        if not should_run:
+            # Cargo.toml may still change with firmware peripheral usage
+            self.write_cargo_toml(
+                output_path, current_hashes, files_root, firmware_src_dir)
+            return
+
+        with staging_dir(output_path) as staging_path:
+            work_path = staging_path / "work"
+            crate_path = staging_path / "crate"
+            work_path.mkdir()
+            crate_path.mkdir()
+
+            # generate PAC src files and format
+            if not svd_src_path.is_file():
+                print("ERROR: SVD input does not exist or is not a file")
+                print(f"(expected here: {svd_src_path.resolve().as_posix()}")
+                sys.exit(1)
+            run_step("rustpac", {
+                "peripheral_features": peripheral_features,
+            }, {"device.svd": svd_src_path}, work_path)
+            src_path = work_path / "src"
+            device_x_path = work_path / "device.x"
+
+            # assemble the crate, then publish it in one rename
+            shutil.copytree(src_path, crate_path / "src")
+            shutil.copy2(device_x_path, crate_path / "device.x")
+
+            # optional linker script
+            if linker_script_src:
+                shutil.copy2(linker_script_src, crate_path / "pac.x")
+
+            (crate_path / "build.rs").write_text(BUILD_RS_CONTENT)
+            self.write_cargo_toml(
+                crate_path, current_hashes, files_root, firmware_src_dir)
+            (crate_path / ".generator_state.json").write_text(
+                json.dumps(current_hashes))
+
+            publish_dir(crate_path, output_path)
+
+    def write_cargo_toml(self, crate_path, current_hashes, files_root,
+                         firmware_src_dir):
+        crate_name = current_hashes["crate_name"]
+
+        # features are re-derived on every run, since firmware usage can
+        # change without the SVD changing
+        features = None
+        default_features = None
+        if current_hashes["peripheral_features"]:
+            features = self.find_peripheral_features(crate_path / "src")
+            if firmware_src_dir:
+                default_features = self.find_used_peripherals(
+                    files_root / firmware_src_dir, features)
+                print(f"[{crate_name}] Peripherals used by firmware: "
+                      f"{', '.join(default_features) or '(none)'}")
+            else:
+                default_features = features
+
+        # only rewrite if changed so cargo doesn't rebuild needlessly
+        cargo_toml_path = crate_path / "Cargo.toml"
+        cargo_toml = self.generate_cargo_toml(
+            crate_name, current_hashes["crate_version"], features,
+            default_features)
+        if (not cargo_toml_path.exists() or
+                cargo_toml_path.read_text() != cargo_toml):
+            write_text_atomic(cargo_toml_path, cargo_toml)
 
 
 if __name__ == "__main__":
@@ -29,13 +29,16 @@
 # OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
 # USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import os
 import subprocess
-import shutil
 import sys
 from pathlib import Path
 
 from fusesoc.capi2.generator import Generator
 
+from jobserver import get_jobserver
+from outputs import output_lock, publish_file
+
 
 class SpinalHdlGen(Generator):
     def run(self):
@@ -45,6 +48,7 @@ class SpinalHdlGen(Generator):
         output_path = self.config.get("output_path")
         file_type = self.config.get("file_type")
         args = self.config.get("args")
+        jvm_jobs = self.config.get("jvm_jobs")
 
         if not sbt_dir:
             sbt_dir = self.files_root
@@ -69,24 +73,42 @@ class SpinalHdlGen(Generator):
         if args:
             command += args
 
-        try:
-            subprocess.check_call(command, cwd=working_dir)
-        except subprocess.CalledProcessError:
-            print("ERROR: SpinalHDL generation failed")
-            sys.exit(1)
-        except FileNotFoundError:
-            print("ERROR: 'sbtn' command not found. Is sbt installed?")
-            sys.exit(1)
-
-        if output_path:
-            src_rtl_path = Path(self.files_root) / output_path
-            dest_rtl_file = Path(output_path).name
+        # hold job slots for the duration of elaboration, and limit the JVM
+        # to the same count (applies when sbtn starts a new sbt server)
+        jobserver = get_jobserver()
+        env = dict(os.environ)
+        if jvm_jobs:
+            jvm_jobs = int(jvm_jobs)
+            java_options = env.get("JAVA_TOOL_OPTIONS", "")
+            env["JAVA_TOOL_OPTIONS"] = (
+                f"{java_options} -XX:ActiveProcessorCount={jvm_jobs}".strip())
+        else:
+            jvm_jobs = 1
 
-            if not src_rtl_path.exists():
-                print(f"ERROR: Generated file not found at {output_path}")
+        # every main in an sbt project can write the same outputs (e.g. the
+        # RTL, SVD and linker script), so concurrent builds elaborate and
+        # copy them out under one lock per project
+        with output_lock(working_dir / "target"):
+            try:
+                with jobserver.slots(jvm_jobs):
+                    subprocess.check_call(command, cwd=working_dir, env=env)
+            except subprocess.CalledProcessError:
+                print("ERROR: SpinalHDL generation failed")
+                sys.exit(1)
+            except FileNotFoundError:
+                print("ERROR: 'sbtn' command not found. Is sbt installed?")
                 sys.exit(1)
-            shutil.copy(src_rtl_path, dest_rtl_file)
 
+            if output_path:
+                src_rtl_path = Path(self.files_root) / output_path
+                dest_rtl_file = Path(output_path).name
+
+                if not src_rtl_path.exists():
+                    print(f"ERROR: Generated file not found at {output_path}")
+                    sys.exit(1)
+                publish_file(src_rtl_path, Path(dest_rtl_file))
+
+        if output_path:
             self.add_files(
                 [dest_rtl_file],
                 fileset="rtl",
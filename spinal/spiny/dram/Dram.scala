@@ -62,6 +62,10 @@ case class SpinyDram(
     val initDone = out Bool()
     val initError = out Bool()
 
+    // User clock outputs for driving testbenches (sim only)
+    val userClk = sim generate (out Bool())
+    val userRst = sim generate (out Bool())
+
     // APB3 control bus
     val apb = slave(Apb3(apb3Config))
 
@@ -89,6 +93,8 @@ case class SpinyDram(
 
   if (sim) {
     liteDram.io.simTrace := True
+    io.userClk := liteDram.io.userClk
+    io.userRst := liteDram.io.userRst
   }
 
   // APB3 to Wishbone bridge (internal, non-bursting)
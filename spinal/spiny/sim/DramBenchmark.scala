@@ -0,0 +1,464 @@
+/*                           /$$                                             **
+**                          |__/                                             **
+**        /$$$$$$$  /$$$$$$  /$$ /$$$$$$$  /$$   /$$                         **
+**       /$$_____/ /$$__  $$| $$| $$__  $$| $$  | $$                         **
+**      |  $$$$$$ | $$  \ $$| $$| $$  \ $$| $$  | $$   (c) Craig J Bishop    **
+**       \____  $$| $$  | $$| $$| $$  | $$| $$  | $$   All rights reserved   **
+**       /$$$$$$$/| $$$$$$$/| $$| $$  | $$|  $$$$$$$                         **
+**      |_______/ | $$____/ |__/|__/  |__/ \____  $$   MIT License           **
+**                | $$                     /$$  | $$                         **
+**                | $$                    |  $$$$$$/                         **
+**                |__/                     \______/                          **
+**                                                                           **
+** Permission is hereby granted, free of charge, to any person obtaining a   **
+** copy of this software and associated documentation files (the             **
+** "Software"), to deal in the Software without restriction, including       **
+** without limitation the rights to use, copy, modify, merge, publish,       **
+** distribute, sublicense, and/or sell copies of the Software, and to permit **
+** persons to whom the Software is furnished to do so, subject to the        **
+** following conditions:                                                     **
+**                                                                           **
+** The above copyright notice and this permission notice shall be included   **
+** in all copies or substantial portions of the Software.                    **
+**                                                                           **
+** THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS   **
+** OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF                **
+** MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN **
+** NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,  **
+** DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR     **
+** OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE **
+** USE OR OTHER DEALINGS IN THE SOFTWARE.                                    */
+
+package spiny.sim
+
+import java.io.{File, FileInputStream, FileWriter}
+import scala.collection.JavaConverters._
+import scala.collection.mutable
+import scala.collection.mutable.ArrayBuffer
+import scala.io.Source
+import scala.util.Random
+
+import org.yaml.snakeyaml.Yaml
+
+import spinal.core._
+import spinal.core.sim._
+import spinal.lib._
+import spinal.lib.bus.amba3.apb._
+import spinal.lib.bus.amba3.apb.sim.Apb3Driver
+
+import spiny.dram._
+
+/** Address order for DRAM benchmark bursts */
+sealed trait DramAccessOrder
+object DramAccessOrder {
+  case object Sequential extends DramAccessOrder
+  case object Random extends DramAccessOrder
+
+  def fromString(s: String): DramAccessOrder = s match {
+    case "sequential" => Sequential
+    case "random" => Random
+    case _ => throw new IllegalArgumentException(s"Unknown access order: $s")
+  }
+}
+
+/** DRAM benchmark traffic pattern
+ *
+ *  @param name Pattern name used in reports
+ *  @param order Sequential or random burst start addresses
+ *  @param readRatio Fraction of bursts that are reads (0.0 to 1.0)
+ *  @param burstLength Number of consecutive port words per burst
+ *  @param numBursts Number of bursts to issue
+ *  @param seed Random seed for addresses, data, and read/write selection
+ */
+case class DramTrafficPattern(
+  name: String,
+  order: DramAccessOrder,
+  readRatio: Double,
+  burstLength: Int,
+  numBursts: Int,
+  seed: Long = 0
+) {
+  assert(readRatio >= 0.0 && readRatio <= 1.0,
+    "readRatio must be between 0.0 and 1.0")
+  assert(burstLength > 0, "burstLength must be > 0")
+}
+
+object DramTrafficPattern {
+  import DramAccessOrder._
+
+  /** Patterns used when none are supplied */
+  def defaults: Seq[DramTrafficPattern] = Seq(
+    DramTrafficPattern("seq_read", Sequential, 1.0, 16, 256),
+    DramTrafficPattern("seq_write", Sequential, 0.0, 16, 256),
+    DramTrafficPattern("seq_mixed", Sequential, 0.5, 16, 256),
+    DramTrafficPattern("rand_read", Random, 1.0, 1, 2048),
+    DramTrafficPattern("rand_mixed", Random, 0.5, 4, 1024)
+  )
+
+  /**
+   * Load patterns from a YAML file containing a list of patterns, e.g.
+   *
+   * {{{
+   * - name: seq_read
+   *   order: sequential
+   *   read_ratio: 1.0
+   *   burst_length: 16
+   *   num_bursts: 256
+   *   seed: 0            # optional
+   * }}}
+   */
+  def fromYaml(path: String): Seq[DramTrafficPattern] = {
+    val yaml = new Yaml()
+    val input = new FileInputStream(path)
+    val data = yaml.load(input).asInstanceOf[java.util.List[Any]]
+    input.close()
+
+    data.asScala.map { entry =>
+      val map = entry.asInstanceOf[java.util.Map[String, Any]].asScala
+      def get(key: String): String = map.get(key) match {
+        case Some(v) if v != null => v.toString
+        case _ => throw new IllegalArgumentException(
+          s"Missing required field in traffic pattern: $key")
+      }
+      DramTrafficPattern(
+        name = get("name"),
+        order = DramAccessOrder.fromString(get("order")),
+        readRatio = get("read_ratio").toDouble,
+        burstLength = get("burst_length").toInt,
+        numBursts = get("num_bursts").toInt,
+        seed = map.get("seed").map(_.toString.toLong).getOrElse(0L)
+      )
+    }.toSeq
+  }
+}
+
+/** Latency summary in user clock cycles */
+case class DramLatencyStats(
+  count: Int,
+  p50: Long,
+  p90: Long,
+  p99: Long,
+  max: Long
+)
+
+object DramLatencyStats {
+  def apply(latencies: Seq[Long]): DramLatencyStats = {
+    val sorted = latencies.sorted
+    def percentile(p: Double): Long = {
+      if (sorted.isEmpty) 0L
+      else sorted(math.max(0, math.ceil(p * sorted.length).toInt - 1))
+    }
+    DramLatencyStats(
+      count = sorted.length,
+      p50 = percentile(0.50),
+      p90 = percentile(0.90),
+      p99 = percentile(0.99),
+      max = sorted.lastOption.getOrElse(0L)
+    )
+  }
+}
+
+/** Result of running one traffic pattern
+ *
+ *  Traffic row hits, misses, and conflicts describe the pattern's address
+ *  stream, assuming LiteDRAM's default ROW_BANK_COL address mapping and an
+ *  open-page policy. They are not measured from the controller, so they
+ *  only differ between configs with different geometries.
+ */
+case class DramBenchmarkResult(
+  pattern: DramTrafficPattern,
+  cycles: Long,
+  bytes: Long,
+  bandwidthMBps: Double,
+  readLatency: DramLatencyStats,
+  writeLatency: DramLatencyStats,
+  trafficRowHits: Long,
+  trafficRowMisses: Long,
+  trafficRowConflicts: Long
+) {
+  def accesses: Long = trafficRowHits + trafficRowMisses + trafficRowConflicts
+
+  def trafficConflictRate: Double = {
+    if (accesses == 0) 0.0 else trafficRowConflicts.toDouble / accesses
+  }
+
+  def toJson: String = {
+    def latencyJson(l: DramLatencyStats) =
+      s"""{"count": ${l.count}, "p50": ${l.p50}, "p90": ${l.p90}, """ +
+      s""""p99": ${l.p99}, "max": ${l.max}}"""
+    s"""{"pattern": ${DramBenchmarkResult.jsonString(pattern.name)}, """ +
+    s""""order": "${pattern.order.toString.toLowerCase}", """ +
+    s""""read_ratio": ${pattern.readRatio}, """ +
+    s""""burst_length": ${pattern.burstLength}, """ +
+    s""""num_bursts": ${pattern.numBursts}, """ +
+    s""""cycles": $cycles, "bytes": $bytes, """ +
+    f""""bandwidth_mbps": $bandwidthMBps%.3f, """ +
+    s""""read_latency": ${latencyJson(readLatency)}, """ +
+    s""""write_latency": ${latencyJson(writeLatency)}, """ +
+    s""""traffic_row_hits": $trafficRowHits, """ +
+    s""""traffic_row_misses": $trafficRowMisses, """ +
+    s""""traffic_row_conflicts": $trafficRowConflicts, """ +
+    f""""traffic_conflict_rate": $trafficConflictRate%.4f}"""
+  }
+}
+
+object DramBenchmarkResult {
+  def jsonString(s: String): String = {
+    "\"" + s.replace("\\", "\\\\").replace("\"", "\\\"") + "\""
+  }
+
+  /**
+   * Flatten the LiteDRAM YAML config into dotted keys, so runs with
+   * different configs (e.g. cmd_buffer_depth) can be compared
+   */
+  def configSummary(configPath: String): Seq[(String, String)] = {
+    val yaml = new Yaml()
+    val input = new FileInputStream(configPath)
+    val data = yaml.load(input).asInstanceOf[java.util.Map[String, Any]]
+    input.close()
+
+    def flatten(prefix: String, value: Any): Seq[(String, String)] = {
+      value match {
+        case m: java.util.Map[_, _] =>
+          m.asScala.toSeq.flatMap { case (k, v) =>
+            flatten(if (prefix.isEmpty) k.toString else s"$prefix.$k", v)
+          }
+        case null => Seq(prefix -> "null")
+        case v => Seq(prefix -> v.toString)
+      }
+    }
+    flatten("", data).sortBy(_._1)
+  }
+
+  /** Append one JSON line per result to the results file */
+  def appendJsonLines(
+    path: String,
+    label: String,
+    configPath: String,
+    results: Seq[DramBenchmarkResult]
+  ) {
+    val config = configSummary(configPath).map { case (k, v) =>
+      s"${jsonString(k)}: ${jsonString(v)}"
+    }.mkString("{", ", ", "}")
+    val timestamp = System.currentTimeMillis() / 1000.0
+
+    val writer = new FileWriter(path, true)
+    results.foreach { result =>
+      writer.write(
+        s"""{"timestamp": $timestamp, "label": ${jsonString(label)}, """ +
+        s""""config": $config, "result": ${result.toJson}}""" + "\n")
+    }
+    writer.close()
+  }
+}
+
+/** Traffic generator and monitor for a LiteDRAM native port
+ *
+ *  Commands are issued back-to-back through DramNativePortDriver, while
+ *  read responses are matched to their commands in order to measure latency.
+ *
+ *  @param port Native port to drive
+ *  @param clockDomain LiteDRAM user clock domain
+ *  @param config LiteDRAM configuration (for geometry and user clock)
+ */
+case class DramBenchmark(
+  port: NativePort,
+  clockDomain: ClockDomain,
+  config: LiteDramConfig
+) {
+  val driver = DramNativePortDriver(port, clockDomain)
+
+  val wordBytes = port.dataWidth / 8
+  val colBits = log2Up(config.geometry.numCols) +
+    log2Up(config.numByteGroups) - log2Up(wordBytes)
+  val bankBits = log2Up(config.geometry.numBanks)
+  val addressMask = (BigInt(1) << port.addressWidth) - 1
+
+  private var cycle = 0L
+  private val pendingReads = mutable.Queue[Long]()
+  private val readLatencies = ArrayBuffer[Long]()
+
+  clockDomain.onSamplings {
+    cycle += 1
+    if (port.read.valid.toBoolean && pendingReads.nonEmpty) {
+      readLatencies += cycle - pendingReads.dequeue()
+    }
+  }
+
+  /** Runs a traffic pattern and waits for all reads to complete */
+  def run(pattern: DramTrafficPattern): DramBenchmarkResult = {
+    val rand = new Random(pattern.seed)
+    val writeLatencies = ArrayBuffer[Long]()
+    val openRows = mutable.Map[BigInt, BigInt]()
+    var rowHits, rowMisses, rowConflicts = 0L
+    var nextAddress = BigInt(0)
+    readLatencies.clear()
+
+    val startCycle = cycle
+    for (_ <- 0 until pattern.numBursts) {
+      val start = pattern.order match {
+        case DramAccessOrder.Sequential =>
+          val address = nextAddress
+          nextAddress = (nextAddress + pattern.burstLength) & addressMask
+          address
+        case DramAccessOrder.Random =>
+          val address = BigInt(port.addressWidth, rand)
+          address - address % pattern.burstLength
+      }
+      val isRead = rand.nextDouble() < pattern.readRatio
+
+      for (i <- 0 until pattern.burstLength) {
+        val address = (start + i) & addressMask
+
+        val bank = (address >> colBits) & ((BigInt(1) << bankBits) - 1)
+        val row = address >> (colBits + bankBits)
+        openRows.get(bank) match {
+          case Some(openRow) if openRow == row => rowHits += 1
+          case Some(_) => rowConflicts += 1
+          case None => rowMisses += 1
+        }
+        openRows(bank) = row
+
+        if (isRead) {
+          pendingReads.enqueue(cycle)
+          driver.issueRead(address)
+        } else {
+          val issueCycle = cycle
+          driver.write(address, BigInt(port.dataWidth, rand))
+          writeLatencies += cycle - issueCycle
+        }
+      }
+    }
+    clockDomain.waitSamplingWhere(pendingReads.isEmpty)
+
+    val cycles = cycle - startCycle
+    val bytes = pattern.numBursts.toLong * pattern.burstLength * wordBytes
+    val seconds = cycles / config.userClkFreq.toDouble
+    DramBenchmarkResult(
+      pattern = pattern,
+      cycles = cycles,
+      bytes = bytes,
+      bandwidthMBps = if (cycles == 0) 0.0 else bytes / seconds / 1e6,
+      readLatency = DramLatencyStats(readLatencies.toSeq),
+      writeLatency = DramLatencyStats(writeLatencies.toSeq),
+      trafficRowHits = rowHits,
+      trafficRowMisses = rowMisses,
+      trafficRowConflicts = rowConflicts
+    )
+  }
+}
+
+/** Testbench top for benchmarking a sim-mode LiteDRAM core */
+case class DramBenchmarkTop(
+  config: LiteDramConfig,
+  portName: String
+) extends Component {
+  val dram = SpinyDram(config, sim = true)
+  val portDataWidth = config.nativePortConfigs(portName).dataWidth
+
+  val io = new Bundle {
+    val apb = slave(Apb3(dram.apb3Config))
+    val nativePort = slave(NativePort(
+      addressWidth = config.nativePortAddressWidth(portDataWidth),
+      dataWidth = portDataWidth
+    ))
+    val initDone = out Bool()
+    val initError = out Bool()
+    val userClk = out Bool()
+    val userRst = out Bool()
+  }
+
+  io.apb <> dram.io.apb
+  io.nativePort <> dram.nativePort(portName)
+  io.initDone := dram.io.initDone
+  io.initError := dram.io.initError
+  io.userClk := dram.io.userClk
+  io.userRst := dram.io.userRst
+}
+
+/**
+ * Benchmarks a sim-mode LiteDRAM core (generated by the FuseSoC litedram
+ * generator with `sim: true`) and appends the results to a JSON lines file.
+ *
+ * Usage:
+ *   DramBenchmarkSim <config.yml> <litex_build dir> <results.jsonl>
+ *                    [patterns.yml] [label]
+ */
+object DramBenchmarkSim extends App {
+  if (args.length < 3) {
+    println("Usage: DramBenchmarkSim <config.yml> <litex_build dir> " +
+      "<results.jsonl> [patterns.yml] [label]")
+    sys.exit(1)
+  }
+
+  val configPath = args(0)
+  val buildDir = new File(args(1))
+  val resultsPath = args(2)
+  val patterns = if (args.length > 3) {
+    DramTrafficPattern.fromYaml(args(3))
+  } else {
+    DramTrafficPattern.defaults
+  }
+  val label = if (args.length > 4) args(4) else new File(configPath).getName
+
+  val config = LiteDramConfig.fromYaml(configPath)
+  val portName = config.nativePortConfigs.keys.toSeq.sorted.headOption
+    .getOrElse(throw new IllegalArgumentException(
+      "LiteDRAM config must have at least one native user port"))
+  val verilogPath = new File(buildDir, s"gateware/${config.name}.v")
+
+  // CSR addresses (e.g. DFII control) from LiteDRAM's csr.csv
+  val csrs = {
+    val source = Source.fromFile(new File(buildDir, "csr.csv"))
+    val entries = source.getLines()
+      .map(_.split(","))
+      .filter(f => f.length >= 3 && f(0) == "csr_register")
+      .map(f => f(1) -> BigInt(f(2).stripPrefix("0x"), 16))
+      .toMap
+    source.close()
+    entries
+  }
+
+  println(f"[DramBenchmark] config: $configPath, port: $portName")
+
+  SimConfig
+    .addRtl(verilogPath.getPath)
+    .compile(DramBenchmarkTop(config, portName))
+    .doSim { dut =>
+      dut.clockDomain.forkStimulus(
+        (1e12 / config.userClkFreq.toDouble).toLong)
+      val userClockDomain = ClockDomain(dut.io.userClk, dut.io.userRst)
+      val apb = Apb3Driver(dut.io.apb, dut.clockDomain)
+      val benchmark = DramBenchmark(dut.io.nativePort, userClockDomain, config)
+      dut.clockDomain.waitSampling(16)
+
+      // hand the DRAM over from software (DFII) to hardware control
+      val ctrlAddressMask = (BigInt(1) << dut.dram.apb3Config.addressWidth) - 1
+      csrs.get("sdram_dfii_control").foreach { address =>
+        apb.write(address & ctrlAddressMask, 0x1)
+      }
+      csrs.get("ddrctrl_init_done").foreach { address =>
+        apb.write(address & ctrlAddressMask, 0x1)
+      }
+      userClockDomain.waitSamplingWhere(100000) {
+        dut.io.initDone.toBoolean
+      }
+      if (dut.io.initError.toBoolean || !dut.io.initDone.toBoolean) {
+        simFailure("LiteDRAM initialization failed")
+      }
+
+      val results = patterns.map { pattern =>
+        val result = benchmark.run(pattern)
+        println(f"[DramBenchmark] ${pattern.name}%-16s " +
+          f"${result.bandwidthMBps}%9.1f MB/s  " +
+          f"read p50/p99 ${result.readLatency.p50}/${result.readLatency.p99} " +
+          f"cycles  traffic row conflicts " +
+          f"${result.trafficConflictRate * 100}%5.1f%%")
+        result
+      }
+
+      DramBenchmarkResult.appendJsonLines(
+        resultsPath, label, configPath, results)
+      println(s"[DramBenchmark] results appended to: $resultsPath")
+    }
+}
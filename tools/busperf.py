@@ -0,0 +1,499 @@
+#                           /$$
+#                          |__/
+#        /$$$$$$$  /$$$$$$  /$$ /$$$$$$$  /$$   /$$
+#       /$$_____/ /$$__  $$| $$| $$__  $$| $$  | $$
+#      |  $$$$$$ | $$  \ $$| $$| $$  \ $$| $$  | $$   (c) Craig J Bishop
+#       \____  $$| $$  | $$| $$| $$  | $$| $$  | $$   All rights reserved
+#       /$$$$$$$/| $$$$$$$/| $$| $$  | $$|  $$$$$$$
+#      |_______/ | $$____/ |__/|__/  |__/ \____  $$   MIT License
+#                | $$                     /$$  | $$
+#                | $$                    |  $$$$$$/
+#                |__/                     \______/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+# NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+# USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Streaming bus performance analyzer for Spiny simulation waveforms
+
+Reconstructs PipelinedMemoryBus and APB3 transactions from a VCD (or FST)
+dump, decodes their addresses to peripheral/register names using the SoC's
+SVD file, and reports throughput, stall cycles, and latency histograms per
+peripheral. Waveforms are parsed line by line from a memory map, so memory
+use stays constant regardless of dump size.
+
+Example:
+    python3 tools/busperf.py simWorkspace/Blinky/test/wave.vcd \\
+        --svd target/spinal/Blinky.svd \\
+        --clock TOP.Blinky.SYS_CLK \\
+        --pmb TOP.Blinky.Cpu.io_dBus \\
+        --apb TOP.Blinky.Apb_bridge_io_apb
+"""
+
+import sys
+import mmap
+import json
+import argparse
+import subprocess
+import xml.etree.ElementTree as ET
+from bisect import bisect_right
+from collections import Counter, deque
+from pathlib import Path
+
+
+# SpinySoC default peripheralsBaseAddress, APB addresses are relative to it
+DEFAULT_APB_BASE = 0x10000000
+
+PMB_SIGNALS = {
+    "cmd_valid": "_cmd_valid",
+    "cmd_ready": "_cmd_ready",
+    "cmd_write": "_cmd_payload_write",
+    "cmd_address": "_cmd_payload_address",
+    "rsp_valid": "_rsp_valid",
+}
+
+APB_SIGNALS = {
+    "psel": "_PSEL",
+    "penable": "_PENABLE",
+    "pready": "_PREADY",
+    "pwrite": "_PWRITE",
+    "paddr": "_PADDR",
+}
+
+UNMAPPED = "(unmapped)"
+
+
+class AddressDecoder:
+    """Maps absolute addresses to (peripheral, register) names from an SVD"""
+
+    def __init__(self, svd_path=None):
+        self.bases = []
+        self.peripherals = []
+        if svd_path is not None:
+            self.load_svd(svd_path)
+
+    def load_svd(self, svd_path):
+        root = ET.parse(svd_path).getroot()
+        peripherals = []
+        for periph in root.iter("peripheral"):
+            name = periph.findtext("name")
+            base = int(periph.findtext("baseAddress"), 0)
+            registers = {}
+            extent = 4
+            for reg in periph.iter("register"):
+                offset = int(reg.findtext("addressOffset"), 0)
+                size = int(reg.findtext("size") or "32", 0) // 8
+                registers[offset] = reg.findtext("name")
+                extent = max(extent, offset + size)
+            peripherals.append((base, name, registers, extent))
+        peripherals.sort(key=lambda p: p[0])
+
+        # each peripheral spans up to the next one, the last one spans
+        # its registers rounded up to a power of two
+        for i, (base, name, registers, extent) in enumerate(peripherals):
+            if i + 1 < len(peripherals):
+                span = peripherals[i + 1][0] - base
+            else:
+                span = 1 << (extent - 1).bit_length()
+            self.bases.append(base)
+            self.peripherals.append((base, span, name, registers))
+
+    def decode(self, address):
+        idx = bisect_right(self.bases, address) - 1
+        if idx >= 0:
+            base, span, name, registers = self.peripherals[idx]
+            if address < base + span:
+                offset = address - base
+                return name, registers.get(offset & ~0x3, f"+0x{offset:x}")
+        return UNMAPPED, f"0x{address:08x}"
+
+
+class PeripheralStats:
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+        self.stall_cycles = 0
+        self.latencies = Counter()
+        self.registers = Counter()
+
+    @property
+    def transactions(self):
+        return self.reads + self.writes
+
+    def record(self, register, write, latency):
+        if write:
+            self.writes += 1
+        else:
+            self.reads += 1
+        self.latencies[latency] += 1
+        self.registers[register] += 1
+
+    def to_dict(self):
+        total = sum(lat * n for lat, n in self.latencies.items())
+        return {
+            "reads": self.reads,
+            "writes": self.writes,
+            "stall_cycles": self.stall_cycles,
+            "avg_latency": total / self.transactions
+                if self.transactions else 0.0,
+            "max_latency": max(self.latencies) if self.latencies else 0,
+            "latency_histogram": {
+                str(k): v for k, v in sorted(self.latencies.items())
+            },
+            "registers": dict(self.registers.most_common()),
+        }
+
+
+class BusMonitor:
+    """
+    Base class for reconstructing transactions from sampled signals.
+    Subclasses define signal_suffixes, data_suffix (the data signal, whose
+    width gives bytes per transfer), and sample(cycle, values).
+    """
+
+    signal_suffixes = {}
+    data_suffix = None
+
+    def __init__(self, prefix, decoder, address_offset=0):
+        self.prefix = prefix
+        self.name = prefix.split(".")[-1]
+        self.decoder = decoder
+        self.address_offset = address_offset
+        self.data_bytes = None
+        self.stats = {}
+
+    def signal_names(self):
+        return {
+            key: self.prefix + suffix
+            for key, suffix in self.signal_suffixes.items()
+        }
+
+    def target(self, address):
+        return self.decoder.decode(address + self.address_offset)
+
+    def stats_for(self, peripheral):
+        if peripheral not in self.stats:
+            self.stats[peripheral] = PeripheralStats()
+        return self.stats[peripheral]
+
+
+class PipelinedMemoryBusMonitor(BusMonitor):
+    """
+    Commands fire on valid && ready. Stalls are cycles with valid && !ready.
+    Write latency is measured from valid to fire, read latency from valid
+    to the matching (in-order) rsp.valid.
+    """
+
+    signal_suffixes = PMB_SIGNALS
+    data_suffix = "_cmd_payload_data"
+
+    def __init__(self, prefix, decoder, address_offset=0):
+        super().__init__(prefix, decoder, address_offset)
+        self.cmd_start = None
+        self.outstanding = deque()
+
+    def sample(self, cycle, values):
+        if values["rsp_valid"] and self.outstanding:
+            peripheral, register, start = self.outstanding.popleft()
+            self.stats_for(peripheral).record(
+                register, False, cycle - start)
+
+        if not values["cmd_valid"]:
+            self.cmd_start = None
+            return
+
+        if self.cmd_start is None:
+            self.cmd_start = cycle
+        peripheral, register = self.target(values["cmd_address"])
+        if not values["cmd_ready"]:
+            self.stats_for(peripheral).stall_cycles += 1
+            return
+
+        if values["cmd_write"]:
+            self.stats_for(peripheral).record(
+                register, True, cycle - self.cmd_start + 1)
+        else:
+            self.outstanding.append((peripheral, register, self.cmd_start))
+        self.cmd_start = None
+
+
+class Apb3Monitor(BusMonitor):
+    """
+    Transfers start with the setup phase (PSEL) and complete on the first
+    access phase cycle with PREADY. Access cycles without PREADY are stalls.
+    """
+
+    signal_suffixes = APB_SIGNALS
+    data_suffix = "_PWDATA"
+
+    def __init__(self, prefix, decoder, address_offset=DEFAULT_APB_BASE):
+        super().__init__(prefix, decoder, address_offset)
+        self.start = None
+
+    def sample(self, cycle, values):
+        if not values["psel"]:
+            self.start = None
+            return
+
+        if self.start is None:
+            self.start = cycle
+        if not values["penable"]:
+            return
+
+        peripheral, register = self.target(values["paddr"])
+        if values["pready"]:
+            self.stats_for(peripheral).record(
+                register, bool(values["pwrite"]), cycle - self.start + 1)
+            self.start = None
+        else:
+            self.stats_for(peripheral).stall_cycles += 1
+
+
+def open_waveform(path):
+    """
+    Yields the lines of a waveform. VCD files are read through a memory
+    map, FST files are streamed through GTKWave's fst2vcd.
+    """
+    if path.suffix == ".fst":
+        try:
+            proc = subprocess.Popen(
+                ["fst2vcd", path.as_posix()], stdout=subprocess.PIPE)
+        except FileNotFoundError:
+            print("ERROR: 'fst2vcd' command not found. Is GTKWave installed?")
+            sys.exit(1)
+        yield from proc.stdout
+        if proc.wait() != 0:
+            print("ERROR: fst2vcd failed")
+            sys.exit(1)
+        return
+
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield from iter(data.readline, b"")
+
+
+def parse_header(lines):
+    """
+    Parse VCD declarations up to $enddefinitions, returning a mapping
+    of hierarchical signal names to (id code, width)
+    """
+    signals = {}
+    scope = []
+    tokens = []
+    for line in lines:
+        tokens.extend(line.split())
+        if b"$end" not in tokens:
+            continue
+
+        keyword = tokens[0]
+        if keyword == b"$scope":
+            scope.append(tokens[2].decode())
+        elif keyword == b"$upscope":
+            scope.pop()
+        elif keyword == b"$var":
+            width = int(tokens[2])
+            id_code = tokens[3]
+            name = ".".join(scope + [tokens[4].decode()])
+            signals[name] = (id_code, width)
+        elif keyword == b"$enddefinitions":
+            return signals
+        tokens = []
+
+    print("ERROR: Waveform ends before $enddefinitions")
+    sys.exit(1)
+
+
+def resolve_signal(signals, name):
+    """Find a signal by full hierarchical name, or by unique suffix"""
+    if name in signals:
+        return signals[name]
+    matches = [s for s in signals if s.endswith("." + name)]
+    if len(matches) == 1:
+        return signals[matches[0]]
+    if not matches:
+        print(f"ERROR: Signal not found in waveform: {name}")
+    else:
+        print(f"ERROR: Signal name is ambiguous: {name}")
+        for match in matches:
+            print(f"       {match}")
+    sys.exit(1)
+
+
+def parse_value(raw):
+    """Parse a VCD value, treating x and z bits as 0"""
+    try:
+        return int(raw, 2)
+    except ValueError:
+        return int(raw.translate(bytes.maketrans(b"xXzZ", b"0000")), 2)
+
+
+def analyze(path, clock, monitors):
+    """
+    Stream through the waveform, sampling all monitored buses on each rising
+    clock edge (using values from before the edge). Returns cycles seen.
+    """
+    lines = open_waveform(path)
+    signals = parse_header(lines)
+
+    clock_id = resolve_signal(signals, clock)[0]
+    state = {}
+    monitor_ids = []
+    for monitor in monitors:
+        ids = {}
+        for key, name in monitor.signal_names().items():
+            id_code = resolve_signal(signals, name)[0]
+            ids[key] = id_code
+            state[id_code] = 0
+        data_width = resolve_signal(
+            signals, monitor.prefix + monitor.data_suffix)[1]
+        monitor.data_bytes = data_width // 8
+        monitor_ids.append((monitor, ids))
+    state[clock_id] = 0
+
+    cycle = 0
+    pending = []
+
+    def flush():
+        nonlocal cycle
+        rising = False
+        for id_code, value in pending:
+            if id_code == clock_id and value and not state[clock_id]:
+                rising = True
+        if rising:
+            for monitor, ids in monitor_ids:
+                monitor.sample(
+                    cycle, {key: state[i] for key, i in ids.items()})
+            cycle += 1
+        for id_code, value in pending:
+            state[id_code] = value
+        pending.clear()
+
+    for line in lines:
+        if not line or line[0] == 0x24:  # '$'
+            continue
+        tokens = line.split()
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            lead = token[0]
+            if lead == 0x23:  # '#'
+                flush()
+                i += 1
+            elif lead in (0x62, 0x42, 0x72, 0x52):  # 'b', 'B', 'r', 'R'
+                id_code = tokens[i + 1]
+                if id_code in state and lead in (0x62, 0x42):
+                    pending.append((id_code, parse_value(token[1:])))
+                i += 2
+            else:
+                id_code = token[1:]
+                if id_code in state:
+                    pending.append((id_code, 1 if lead == 0x31 else 0))
+                i += 1
+    flush()
+
+    return cycle
+
+
+def histogram_text(latencies):
+    return "  ".join(f"{lat}:{n}" for lat, n in sorted(latencies.items()))
+
+
+def print_report(cycles, monitors):
+    for monitor in monitors:
+        stats = monitor.stats
+        total = sum(s.transactions for s in stats.values())
+        print(f"[{monitor.name}] {cycles} cycles, {total} transactions")
+        if not stats:
+            continue
+
+        print(f"  {'Peripheral':<16} {'Reads':>8} {'Writes':>8} "
+              f"{'Txn/kcyc':>9} {'B/cyc':>7} {'Stalls':>8} "
+              f"{'Avg lat':>8} {'Max lat':>8}")
+        for name, s in sorted(stats.items(),
+                              key=lambda kv: -kv[1].transactions):
+            d = s.to_dict()
+            per_kcycle = 1000.0 * s.transactions / cycles if cycles else 0.0
+            bytes_per_cycle = (s.transactions * monitor.data_bytes / cycles
+                               if cycles else 0.0)
+            print(f"  {name:<16} {s.reads:>8} {s.writes:>8} "
+                  f"{per_kcycle:>9.2f} {bytes_per_cycle:>7.3f} "
+                  f"{s.stall_cycles:>8} {d['avg_latency']:>8.2f} "
+                  f"{d['max_latency']:>8}")
+
+        print("  Latency histograms (cycles:count):")
+        for name, s in sorted(stats.items()):
+            print(f"    {name:<16} {histogram_text(s.latencies)}")
+            top = ", ".join(
+                f"{reg} x{n}" for reg, n in s.registers.most_common(5))
+            print(f"    {'':<16} registers: {top}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Analyze bus performance in Spiny simulation waveforms")
+    parser.add_argument("waveform", type=Path,
+        help="VCD or FST waveform file")
+    parser.add_argument("--svd", type=Path,
+        help="SoC SVD file for decoding peripheral/register names")
+    parser.add_argument("--clock", required=True,
+        help="Clock signal name (full hierarchical name or unique suffix)")
+    parser.add_argument("--pmb", action="append", default=[],
+        help="PipelinedMemoryBus signal prefix (e.g. TOP.Soc.Cpu.io_dBus)")
+    parser.add_argument("--apb", action="append", default=[],
+        help="APB3 signal prefix (e.g. TOP.Soc.Apb_bridge_io_apb)")
+    parser.add_argument("--apb-base", type=lambda v: int(v, 0),
+        default=DEFAULT_APB_BASE,
+        help="Base address added to APB PADDR (default 0x10000000)")
+    parser.add_argument("--json", type=Path,
+        help="Also write the report as JSON to this path")
+    args = parser.parse_args()
+
+    if not args.pmb and not args.apb:
+        print("ERROR: At least one --pmb or --apb bus is required")
+        sys.exit(1)
+    if not args.waveform.is_file():
+        print(f"ERROR: Waveform not found: {args.waveform}")
+        sys.exit(1)
+    if args.svd is not None and not args.svd.is_file():
+        print(f"ERROR: SVD not found: {args.svd}")
+        sys.exit(1)
+
+    decoder = AddressDecoder(args.svd)
+    monitors = (
+        [PipelinedMemoryBusMonitor(p, decoder) for p in args.pmb] +
+        [Apb3Monitor(p, decoder, args.apb_base) for p in args.apb]
+    )
+
+    cycles = analyze(args.waveform, args.clock, monitors)
+    print_report(cycles, monitors)
+
+    if args.json:
+        args.json.write_text(json.dumps({
+            "cycles": cycles,
+            "buses": {
+                m.prefix: {
+                    name: s.to_dict() for name, s in m.stats.items()
+                } for m in monitors
+            },
+        }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
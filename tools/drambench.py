@@ -0,0 +1,136 @@
+#                           /$$
+#                          |__/
+#        /$$$$$$$  /$$$$$$  /$$ /$$$$$$$  /$$   /$$
+#       /$$_____/ /$$__  $$| $$| $$__  $$| $$  | $$
+#      |  $$$$$$ | $$  \ $$| $$| $$  \ $$| $$  | $$   (c) Craig J Bishop
+#       \____  $$| $$  | $$| $$| $$  | $$| $$  | $$   All rights reserved
+#       /$$$$$$$/| $$$$$$$/| $$| $$  | $$|  $$$$$$$
+#      |_______/ | $$____/ |__/|__/  |__/ \____  $$   MIT License
+#                | $$                     /$$  | $$
+#                | $$                    |  $$$$$$/
+#                |__/                     \______/
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN
+# NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE
+# USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Compare DRAM benchmark results across LiteDRAM configurations
+
+Reads the JSON lines written by spiny.sim.DramBenchmarkSim and prints one
+table per traffic pattern, with a row per run. Config keys that differ
+between runs are shown next to each run, so the effect of changes like
+`cmd_buffer_depth` is easy to see.
+
+The results' traffic row counts are not compared: they describe each
+pattern's address stream, not the controller, so they can't tell configs
+apart.
+
+Example:
+    python3 tools/drambench.py target/dram_bench.jsonl
+"""
+
+import sys
+import json
+import argparse
+from pathlib import Path
+
+
+def load_runs(path):
+    runs = []
+    for line_num, line in enumerate(path.read_text().splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            runs.append(json.loads(line))
+        except json.JSONDecodeError:
+            print(f"WARNING: Skipping invalid line {line_num} in {path}")
+    return runs
+
+
+def differing_config_keys(runs):
+    keys = set()
+    for run in runs:
+        keys.update(run.get("config", {}).keys())
+    return sorted(
+        key for key in keys
+        if len({run.get("config", {}).get(key) for run in runs}) > 1
+    )
+
+
+def print_comparison(runs, patterns=None):
+    config_keys = differing_config_keys(runs)
+
+    by_pattern = {}
+    for run in runs:
+        name = run["result"]["pattern"]
+        if patterns and name not in patterns:
+            continue
+        by_pattern.setdefault(name, []).append(run)
+
+    for name, pattern_runs in by_pattern.items():
+        print(f"[{name}]")
+        header = (f"  {'Label':<24} {'MB/s':>9} {'Rd p50':>7} {'Rd p99':>7} "
+                  f"{'Wr p50':>7}")
+        for key in config_keys:
+            header += f"  {key}"
+        print(header)
+
+        for run in pattern_runs:
+            r = run["result"]
+            row = (f"  {run['label']:<24} {r['bandwidth_mbps']:>9.1f} "
+                   f"{r['read_latency']['p50']:>7} "
+                   f"{r['read_latency']['p99']:>7} "
+                   f"{r['write_latency']['p50']:>7}")
+            for key in config_keys:
+                row += f"  {run['config'].get(key, '-')}"
+            print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare DRAM benchmark results across configurations")
+    parser.add_argument("results", type=Path,
+        help="JSON lines results file from DramBenchmarkSim")
+    parser.add_argument("--pattern", action="append",
+        help="Only show this traffic pattern (may be repeated)")
+    parser.add_argument("--last", type=int, default=0,
+        help="Only compare the last N runs of each pattern")
+    args = parser.parse_args()
+
+    if not args.results.is_file():
+        print(f"ERROR: Results file not found: {args.results}")
+        sys.exit(1)
+
+    runs = load_runs(args.results)
+    if args.last > 0:
+        counts = {}
+        kept = []
+        for run in reversed(runs):
+            name = run["result"]["pattern"]
+            counts[name] = counts.get(name, 0) + 1
+            if counts[name] <= args.last:
+                kept.append(run)
+        runs = list(reversed(kept))
+
+    print_comparison(runs, args.pattern)
+
+
+if __name__ == "__main__":
+    main()